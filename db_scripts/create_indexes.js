@@ -1,3 +1,24 @@
 #!/usr/bin/env mongo
 var db = new Mongo().getDB("wikiloult");
-db.pages.createIndex({title: "text", html_content : "text"});
\ No newline at end of file
+// the former text index covered the pages' HTML, the new one their plain text
+db.pages.getIndexes().forEach(function (index) {
+    if (index.name === "title_text_html_content_text") {
+        db.pages.dropIndex(index.name);
+    }
+});
+db.pages.createIndex({title: "text", raw_text: "text"},
+                     {default_language: "french", weights: {title: 5, raw_text: 1}});
+db.revisions.createIndex({page: 1, rev: 1}, {unique: true});
+db.revisions.createIndex({edition_time: -1});
+if (!db.getCollectionNames().includes("recent_edits")) {
+    db.createCollection("recent_edits", {capped: true, size: 4 * 1024 * 1024, max: 1000});
+}
+// the pages index is paginated on (sort_key, _id), which also serves the queries on sort_key
+db.pages.getIndexes().forEach(function (index) {
+    if (index.name === "sort_key_1") {
+        db.pages.dropIndex(index.name);
+    }
+});
+db.pages.createIndex({sort_key: 1, _id: 1});
+db.users.createIndex({short_id: 1}, {unique: true});
+db.rate_limits.createIndex({expire_at: 1}, {expireAfterSeconds: 0});
@@ -1,30 +1,38 @@
 import re
 from functools import wraps
-from os import makedirs
-from os.path import join, dirname, realpath
 from html import escape
 
 import flask_admin as admin
-from flask import Flask, render_template, session, redirect, url_for, request, abort, make_response
+from flask import Flask, render_template, session, redirect, url_for, request, abort, make_response, \
+    send_from_directory, g, Response, stream_with_context
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_login import LoginManager, login_required, login_user, current_user, logout_user
 
-from config import SECRET_KEY
+from config import SECRET_KEY, AUDIO_RENDER_WORKERS, AUDIO_RENDER_RETRIES, \
+    RATELIMIT_STORAGE_URI, STREAM_BUFFER_SIZE
 from tools.admin import UserView, PageView, CheckCookieAdminView
-from tools.models import UsersConnector, WikiPagesConnector
-from tools.rendering import audio_render, WikiPageRenderer
+from tools.audio import AudioRenderQueue, AUDIO_FOLDER, audio_filename, audio_path
+from tools.caching import make_etag, is_not_modified, not_modified_response, cacheable
+from tools.fragments import get_fragment_cache
+from tools import metrics
+from tools.models import UsersConnector, WikiPagesConnector, group_by_first_letter
+from tools import ratelimit  # registers the shared storages of the rate limits
+from tools.rendering import get_renderer
 from tools.users import User
 
 app = Flask(__name__)
 
-AUDIO_RENDER_FOLDER = join(dirname(realpath(__file__)), "static/sound/")
+audio_queue = AudioRenderQueue(AUDIO_RENDER_WORKERS, AUDIO_RENDER_RETRIES)
 
 
 app.config['SECRET_KEY'] = SECRET_KEY
+app.config['RATELIMIT_STORAGE_URI'] = RATELIMIT_STORAGE_URI
 
 app.config.from_envvar('DEV_SETTINGS', silent=True)
 
+metrics.init_app(app)
+
 # limiter to temper with registration abuse
 registration_limiter = Limiter(
     app,
@@ -47,6 +55,23 @@ def load_user(user_cookie):
     return User(user_cookie)
 
 
+def user_state(user_cookie):
+    """The user's state (see `UsersConnector.get_user_state`), looked up once per request"""
+    states = g.setdefault("user_states", {})
+    if user_cookie not in states:
+        states[user_cookie] = UsersConnector().get_user_state(user_cookie)
+    return states[user_cookie]
+
+
+def stream_page(template_name, **context):
+    """Renders a template while it's being sent, for the views listing many items: the page's
+    header goes out at once, and the items are read from their cursor as they're rendered"""
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return Response(stream_with_context(stream), mimetype="text/html")
+
+
 def autologin(function):
     @wraps(function)
     def with_login():
@@ -84,9 +109,7 @@ def login():
 
     elif request.method == "POST":
         user_cookie = request.form["user"]
-        user_cnctr = UsersConnector()
-
-        if not user_cnctr.user_exists(user_cookie):
+        if not user_state(user_cookie)["exists"]:
             return redirect(url_for('register'))
         else:
             message = "Connectèw."
@@ -110,9 +133,8 @@ def logout():
 @autologin
 @registration_limiter.limit("1/day", error_message="Une inscription par jour.", exempt_when= lambda: request.method == 'GET')
 def register():
-    user_cnctr = UsersConnector()
     if request.method == 'GET':
-        if user_cnctr.user_exists(request.cookies.get("id", None)):
+        if user_state(request.cookies.get("id", None))["exists"]:
             message= "Connectèw."
         else:
             message=None
@@ -120,8 +142,8 @@ def register():
     
     elif request.method == 'POST':
         user_cookie = request.form["user"]
-        if not user_cnctr.user_exists(user_cookie):
-            user_cnctr.register_user(user_cookie)
+        if not user_state(user_cookie)["exists"]:
+            UsersConnector().register_user(user_cookie)
             message = """Votre compte utilisateur a été créé.
             Un administrateur doit le valider pour que vous puissiez aussi éditer des pages."""        
         else:
@@ -135,20 +157,69 @@ def register():
 def page(page_name):
     """Display a wiki page"""
     page_cnctr = WikiPagesConnector()
-    page_data = page_cnctr.get_page_data(page_name)
-    return render_template("wiki_page.html",
-                           page_data=page_data,
-                           page_name=page_name,
-                           audio_filename=page_name + ".wav")
+    page_summary = page_cnctr.get_page_summary(page_name)
+    if page_summary is None:
+        return render_template("wiki_page.html", page_data=None, page_name=page_name)
+
+    title_audio_path = audio_path(page_summary["title"])
+    if not audio_queue.is_ready(title_audio_path):
+        # pages written before the audio files were content-addressed have theirs made on first view
+        audio_queue.submit(page_summary["title"], title_audio_path)
+    audio_status = audio_queue.status(title_audio_path)
+    etag = make_etag("page", page_summary["last_edit"], audio_status)
+    # the page changes when its audio gets ready, which the date of its last edit doesn't tell: it
+    # only has a Last-Modified (and answers If-Modified-Since) once the audio is there
+    last_modified = page_summary["last_edit"] if audio_status == AudioRenderQueue.DONE else None
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+
+    # the page's body is the same for everyone, so it's only rendered again after an edit
+    fragment_cache = get_fragment_cache()
+    stamp = fragment_cache.revision_stamp(page_summary)
+    page_fragment = fragment_cache.get(page_name, stamp)
+    if page_fragment is None:
+        page_data = page_cnctr.get_page_data(page_name)
+        if page_data is None:
+            abort(404)
+        page_fragment = render_template("wiki_page_content.html", page_data=page_data)
+        fragment_cache.put(page_name, stamp, page_fragment)
+    return cacheable(render_template("wiki_page.html",
+                                     page_data=page_summary,
+                                     page_fragment=page_fragment,
+                                     page_name=page_name,
+                                     audio_filename=audio_filename(page_summary["title"]),
+                                     audio_status=audio_status),
+                     etag, last_modified)
 
 @app.route("/page/<page_name>/history")
 @autologin
 def page_history(page_name):
     """Display a page's edit history"""
+    after, before = request.args.get("after"), request.args.get("before")
     page_cnctr = WikiPagesConnector()
-    page_history = page_cnctr.get_page_history(page_name)
-    return render_template("page_history.html",
-                           page_history=reversed(page_history),
+    page_summary = page_cnctr.get_page_summary(page_name)
+    if page_summary is None:
+        abort(404)
+    etag = make_etag("history", page_summary["last_edit"], after, before)
+    if is_not_modified(etag, page_summary["last_edit"]):
+        return not_modified_response(etag, page_summary["last_edit"])
+
+    return cacheable(stream_page("page_history.html",
+                                 page_history=page_cnctr.get_page_history(page_name, after, before),
+                                 page_name=page_name),
+                     etag, page_summary["last_edit"])
+
+
+@app.route("/page/<page_name>/history/<int:edit_id>")
+@autologin
+def page_revision(page_name, edit_id):
+    """Display a single revision of a page"""
+    page_cnctr = WikiPagesConnector()
+    revision = page_cnctr.get_revision(page_name, edit_id)
+    if revision is None:
+        abort(404)
+    return render_template("page_revision.html",
+                           edit=revision,
                            page_name=page_name)
 
 
@@ -157,8 +228,7 @@ def page_history(page_name):
 @autologin
 def page_edit(page_name):
     """Page edition form"""
-    user_cnctr = UsersConnector()
-    if not user_cnctr.is_allowed(current_user.cookie):
+    if not user_state(current_user.cookie)["is_allowed"]:
         return render_template("error.html", message="Vous n'êtes pas encore autorisé à éditer des pages")
 
     page_cnctr = WikiPagesConnector()
@@ -177,7 +247,7 @@ def page_edit(page_name):
         markdown_content = request.form["content"]
 
         if request.form.get("preview", None) is not None:
-            markdown_renderer = WikiPageRenderer()
+            markdown_renderer = get_renderer()
             html_render = markdown_renderer.render(escape(markdown_content))
             return render_template("page_edit.html",
                                    page_name=page_name,
@@ -193,8 +263,8 @@ def page_edit(page_name):
                                    message="Le titre ni le contenu ne doivent être vides.")
 
         page_cnctr.edit_page(page_name, markdown_content, title, current_user.cookie)
-        audio_render(title, join(AUDIO_RENDER_FOLDER, page_name + ".wav"))
-        user_cnctr.add_modification(current_user.cookie, page_name)
+        audio_queue.submit(title, audio_path(title))
+        UsersConnector().add_modification(current_user.cookie, page_name)
         return redirect(url_for("page", page_name=page_name))
 
 @app.route("/restore")
@@ -207,20 +277,13 @@ def page_restore():
     page_name = request.args.get('page_name')
     edit_id = int(request.args.get('edit_id'))
     page_cnctr = WikiPagesConnector()
-    page_data = page_cnctr.get_page_data(page_name)
-    if page_data is None:
+    selected_edit = page_cnctr.get_revision(page_name, edit_id)
+    if selected_edit is None:
         abort(500)
-
-    page_history = page_cnctr.get_page_history(page_name)
-    try:
-        selected_edit = page_history[edit_id]
-    except IndexError:
-        abort(500)
-    else:
-        return render_template("page_edit.html",
-                               page_name=page_name,
-                               page_content=selected_edit["markdown"],
-                               page_title=selected_edit["title"])
+    return render_template("page_edit.html",
+                           page_name=page_name,
+                           page_content=selected_edit["markdown"],
+                           page_title=selected_edit["title"])
 
 
 @app.route("/page/create", methods=['GET', 'POST'])
@@ -228,8 +291,7 @@ def page_restore():
 @autologin
 def page_create():
     """Page creation form (almost the same as the page edition form"""
-    user_cnctr = UsersConnector()
-    if not user_cnctr.is_allowed(current_user.cookie):
+    if not user_state(current_user.cookie)["is_allowed"]:
         return render_template("error.html", message="Vous n'êtes pas encore autorisé à éditer des pages")
 
     page_cnctr = WikiPagesConnector()
@@ -243,7 +305,7 @@ def page_create():
         markdown_content = request.form["content"]
 
         if request.form.get("preview", None) is not None:
-            markdown_renderer = WikiPageRenderer()
+            markdown_renderer = get_renderer()
             html_render = markdown_renderer.render(escape(markdown_content))
             return render_template("page_create.html",
                                    page_content=markdown_content,
@@ -267,11 +329,7 @@ def page_create():
                                    message=error_message)
 
         page_cnctr.create_page(page_name.lower(), markdown_content, title, current_user.cookie)
-        try:
-            makedirs(AUDIO_RENDER_FOLDER)
-        except FileExistsError:
-            pass
-        audio_render(title, join(AUDIO_RENDER_FOLDER, page_name + ".wav"))
+        audio_queue.submit(title, audio_path(title))
         return redirect(url_for("page", page_name=page_name))
 
 
@@ -280,12 +338,9 @@ def page_create():
 def user_page(user_id):
     """User's personal page"""
     user_cnctr = UsersConnector()
-    user_data = user_cnctr.get_user_data(user_id)
+    user_data = user_cnctr.get_user_data(user_id, modifications_after=request.args.get("after"))
     if user_data is None:
         abort(404)
-    user_data["modifications"].reverse()
-    if len(user_data["modifications"]) > 15:
-        user_data["modifications"] = user_data["modifications"][:15]
     return render_template("user_page.html", user_data=user_data, user=User(user_data["_id"]))
 
 
@@ -295,14 +350,14 @@ def user_page(user_id):
 def profile_edit():
     user_cnctr = UsersConnector()
     if request.method == "GET":
-        user_data = user_cnctr.get_user_data(current_user.user_id)
+        user_data = user_cnctr.get_user_data(current_user.user_id, modifications_count=0)
         return render_template("user_profile_edit.html", profile_markdown=user_data["personal_text_markdown"])
 
     elif request.method == "POST":
         markdown_content = request.form["content"]
 
         if request.form.get("preview", None) is not None:
-            markdown_renderer = WikiPageRenderer()
+            markdown_renderer = get_renderer()
             html_render = markdown_renderer.render(escape(markdown_content))
             return render_template("user_profile_edit.html",
                                    profile_markdown=markdown_content,
@@ -327,10 +382,8 @@ def search_page():
     """Search for a wiki page"""
     search_query = request.args.get('query', '')
     page_cnctr = WikiPagesConnector()
-    results = page_cnctr.search_pages(search_query)
-    for result in results:
-        result["raw_text"] = re.sub('<[^<]+?>', '', result["html_content"])
-    return render_template("page_search.html", results_list=results)
+    return stream_page("page_search.html",
+                       results_list=page_cnctr.search(search_query, request.args.get("after")))
 
 
 @app.route("/random")
@@ -338,7 +391,24 @@ def search_page():
 def random_page():
     """Search for a wiki page"""
     page_cnctr = WikiPagesConnector()
-    return redirect(url_for("page", page_name=page_cnctr.get_random_page()))
+    page_name = page_cnctr.get_random_page()
+    if page_name is None:
+        # the wiki is empty
+        return redirect(url_for("page_create"))
+    return redirect(url_for("page", page_name=page_name))
+
+
+def last_edited_pages(page_cnctr):
+    """The last edits, with the consecutive edits of a page by the same user merged"""
+    last_edited = []
+    last_editor, last_page = None, None
+    for edit in page_cnctr.get_last_edited(30):
+        if edit["editor_cookie"] != last_editor or edit["page"] != last_page:
+            edit["editor"] = User(edit["editor_cookie"])
+            last_edited.append(edit)
+            last_editor = edit["editor_cookie"]
+            last_page = edit["page"]
+    return last_edited
 
 
 @app.route("/last_edits")
@@ -346,23 +416,32 @@ def random_page():
 def last_edits():
     """Display pages that where last edited"""
     page_cnctr = WikiPagesConnector()
-    last_edited_pages = []
-    last_editor, last_page = None, None
-    for page in page_cnctr.get_last_edited(30):
-        if page["history"]["editor_cookie"] != last_editor or page["_id"] != last_page:
-            page["raw_text"] = re.sub('<[^<]+?>', '', page["html_content"])
-            page["last_editor"] = User(page["history"]["editor_cookie"])
-            last_edited_pages.append(page)
-            last_editor = page["history"]["editor_cookie"]
-            last_page = page["_id"]
+    etag = make_etag("last_edits", page_cnctr.get_version())
+    if is_not_modified(etag):
+        return not_modified_response(etag)
 
-    return render_template("last_edited.html", results_list=last_edited_pages)
+    return cacheable(render_template("last_edited.html", results_list=last_edited_pages(page_cnctr)), etag)
 
 @app.route("/all")
 @autologin
 def all_pages():
+    after, before = request.args.get("after"), request.args.get("before")
     page_cnctr = WikiPagesConnector()
-    return render_template("all_pages.html", pages_per_first_letter=page_cnctr.get_all_pages_sorted())
+    etag = make_etag("all", page_cnctr.get_version(), after, before)
+    if is_not_modified(etag):
+        return not_modified_response(etag)
+    pages = page_cnctr.get_pages_sorted(after, before)
+    return cacheable(stream_page("all_pages.html",
+                                 pages_per_first_letter=group_by_first_letter(pages.items),
+                                 pages=pages),
+                     etag)
+
+@app.route("/sound/<filename>")
+def audio_file(filename):
+    """Title audio files. Their names are hashes of their content, so they can be cached forever"""
+    response = send_from_directory(AUDIO_FOLDER, filename)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
 
 #### routes for static pages
 
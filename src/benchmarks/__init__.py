@@ -0,0 +1,2 @@
+"""Benchmarks for the wiki's hot paths. Run them from the src/ folder, e.g.
+``python -m benchmarks.connectors``"""
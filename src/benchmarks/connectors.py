@@ -0,0 +1,45 @@
+"""Compares the per-request cost of opening a new MongoClient (what the connectors used to do)
+with the process-wide pooled client. Needs a running MongoDB at config.DB_ADDRESS."""
+import argparse
+import time
+
+from pymongo import MongoClient
+
+from config import DB_ADDRESS, PAGES_COLLECTION_NAME
+from tools.models import WikiPagesConnector, close_client
+
+
+def fresh_client_request():
+    # what a route used to do: a brand new client, one query, then the client is dropped
+    client = MongoClient(DB_ADDRESS)
+    client["wikiloult"][PAGES_COLLECTION_NAME].find_one({"_id": "histoire"}, {"title": 1})
+    client.close()
+
+
+def pooled_client_request():
+    WikiPagesConnector().pages.find_one({"_id": "histoire"}, {"title": 1})
+
+
+def requests_per_second(request_func, duration: float):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        request_func()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds spent on each variant")
+    args = parser.parse_args()
+
+    pooled_client_request()  # warming up the pool, like the first request of a worker would
+    for name, func in (("new client per request", fresh_client_request),
+                       ("pooled client", pooled_client_request)):
+        print("%-25s %8.1f req/s" % (name, requests_per_second(func, args.duration)))
+    close_client()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+"""Comparison of benchmark results with those of a previous run"""
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """Prints the change of each benchmark against the baseline, returns the regressed ones"""
+    regressions = []
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        ratio = result["median_ms"] / baseline["results"][name]["median_ms"]
+        if ratio > 1 + threshold:
+            verdict = "slower"
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            verdict = "faster"
+        else:
+            verdict = ""
+        print("%-35s %9.3f ms -> %9.3f ms  x%.2f %s" % (name, baseline["results"][name]["median_ms"],
+                                                       result["median_ms"], ratio, verdict))
+    return regressions
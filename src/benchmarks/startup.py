@@ -0,0 +1,64 @@
+"""Cold start of the app and of the admin scripts: time taken by a fresh interpreter to import
+them, and to build the first User. Each measure runs in its own process, so nothing is shared
+with the previous ones but the OS' file cache. Doesn't need a database.
+
+    python -m benchmarks.startup --output before.json
+    python -m benchmarks.startup --output after.json --baseline before.json"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.results import compare
+
+# what each measure runs, after the interpreter itself is up
+TARGETS = {"import.tools.users": "import tools.users",
+           "import.tools.models": "import tools.models",
+           "import.manage": "import manage",
+           "import.app": "import app",
+           "first_user": "from tools.users import User; User('cookie')"}
+
+
+def run_once(code: str) -> float:
+    # the time is measured inside the child, so the interpreter's own startup isn't counted
+    script = "import time; start = time.perf_counter()\n%s\nprint(time.perf_counter() - start)" % code
+    output = subprocess.run([sys.executable, "-c", script], check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    return float(output.split()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10, help="processes started for each measure")
+    parser.add_argument("--output", default="startup.json", help="where the JSON results are written")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative change of the median under which a measure is unchanged")
+    args = parser.parse_args()
+
+    results = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": sys.version.split()[0],
+               "parameters": {"repeat": args.repeat},
+               "results": {}}
+    for name, code in TARGETS.items():
+        run_once(code)  # warms up the file cache, and builds the packed tables if needed
+        timings = [run_once(code) for _ in range(args.repeat)]
+        results["results"][name] = {"runs": args.repeat,
+                                    "median_ms": statistics.median(timings) * 1000,
+                                    "min_ms": min(timings) * 1000}
+        print("%-35s %9.3f ms" % (name, results["results"][name]["median_ms"]))
+
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        if regressions:
+            sys.exit("slower than the baseline: " + ", ".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
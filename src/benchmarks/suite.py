@@ -0,0 +1,205 @@
+"""Benchmarks of the wiki's hot paths, run offline against an in-memory MongoDB (mongomock)
+filled with a generated wiki. Results are written as JSON, and can be compared against the
+results of a previous run:
+
+    python -m benchmarks.suite --output before.json
+    python -m benchmarks.suite --output after.json --baseline before.json
+
+Needs the mongomock package, which isn't a dependency of the wiki itself."""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from html import escape
+
+try:
+    import mongomock
+except ImportError:
+    sys.exit("The benchmarks need mongomock: pip install mongomock")
+
+from benchmarks.results import compare
+from tools import models, search
+from tools.models import UsersConnector, WikiPagesConnector
+from tools.rendering import build_markdown_engine, get_renderer
+from tools.users import User, derive_identity
+
+WORDS = ("loult", "pokémon", "wiki", "salon", "vocaroo", "modération", "électhor", "scorplane", "bière",
+         "serveur", "écran", "chanson", "histoire", "règle", "poney", "ban", "flood", "musique", "été",
+         "forum", "canapé", "délire", "copain", "fromage", "quiche", "soirée", "tribunal", "trône")
+
+
+class GeneratedWiki:
+    """Fills the database with `pages` pages having `revisions` revisions each, written by
+    `users` users, always the same for a given seed"""
+
+    def __init__(self, pages: int, revisions: int, users: int, seed: int = 0):
+        self.pages, self.revisions, self.users = pages, revisions, users
+        self.random = random.Random(seed)
+        self.cookies = ["cookie-%d" % i for i in range(users)]
+        self.page_names = ["page-%d" % i for i in range(pages)]
+
+    def sentence(self, length: int = 12):
+        return " ".join(self.random.choice(WORDS) for _ in range(length)).capitalize() + "."
+
+    def markdown(self):
+        blocks = []
+        for section in range(self.random.randint(2, 5)):
+            blocks.append("## " + self.sentence(3))
+            blocks.append(" ".join(self.sentence() for _ in range(self.random.randint(2, 6))))
+            blocks.append("\n".join("* **%s** [[%s]]" % (self.sentence(2), self.random.choice(self.page_names))
+                                    for _ in range(self.random.randint(1, 4))))
+        return "\n\n".join(blocks)
+
+    def populate(self):
+        users_cnctr, page_cnctr = UsersConnector(), WikiPagesConnector()
+        for cookie in self.cookies:
+            users_cnctr.register_user(cookie)
+        users_cnctr.users.update_many({}, {"$set": {"is_allowed": True}})
+
+        for page_name in self.page_names:
+            title = self.sentence(2)[:-1]
+            page_cnctr.create_page(page_name, self.markdown(), title, self.random.choice(self.cookies))
+            for _ in range(self.revisions - 1):
+                editor = self.random.choice(self.cookies)
+                page_cnctr.edit_page(page_name, self.markdown(), title, editor)
+                users_cnctr.add_modification(editor, page_name)
+
+
+def measure(func, repeat: int, warmup: int = 1):
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    median = statistics.median(timings)
+    return {"runs": repeat,
+            "mean_ms": statistics.mean(timings) * 1000,
+            "median_ms": median * 1000,
+            "min_ms": min(timings) * 1000,
+            "stdev_ms": (statistics.stdev(timings) if repeat > 1 else 0.0) * 1000,
+            "ops_per_s": 1 / median if median else float("inf")}
+
+
+def benchmarks(wiki: GeneratedWiki, markdown_samples):
+    """The benchmarked functions, by name"""
+    page_cnctr = WikiPagesConnector()
+    page_names = wiki.page_names
+    uncached_engine = build_markdown_engine()
+
+    def render_uncached():
+        for sample in markdown_samples:
+            uncached_engine(escape(sample))
+
+    def render_cached():
+        renderer = get_renderer()
+        for sample in markdown_samples:
+            renderer.render(escape(sample))
+
+    def users_cold():
+        derive_identity.cache_clear()
+        for cookie in wiki.cookies:
+            User(cookie)
+
+    def users_warm():
+        for cookie in wiki.cookies:
+            User(cookie)
+
+    def all_pages_sorted():
+        for letter, pages in page_cnctr.iter_pages_sorted():
+            for page_data in pages:
+                pass
+
+    def page_history():
+        page_cnctr.get_page_history(page_names[0])
+
+    def search_pages():
+        for word in WORDS[:5]:
+            page_cnctr.search_pages(word)
+
+    import app as app_module
+    # the page route would synthesize the titles' audio, which is beside the point here
+    app_module.audio_queue.submit = lambda text, render_path: None
+    client = app_module.app.test_client()
+
+    def route(url):
+        def get():
+            response = client.get(url)
+            if response.status_code not in (200, 302):
+                raise RuntimeError("%s answered %d" % (url, response.status_code))
+        return get
+
+    return {"render.uncached": render_uncached,
+            "render.cached": render_cached,
+            "users.cold": users_cold,
+            "users.warm": users_warm,
+            "connector.get_page_data": lambda: page_cnctr.get_page_data(page_names[0]),
+            "connector.get_page_history": page_history,
+            "connector.get_last_edited": lambda: page_cnctr.get_last_edited(30),
+            "connector.iter_pages_sorted": all_pages_sorted,
+            "connector.get_pages_sorted": page_cnctr.get_pages_sorted,
+            "connector.search_pages": search_pages,
+            "route.page": route("/page/" + page_names[0]),
+            "route.history": route("/page/%s/history" % page_names[0]),
+            "route.last_edits": route("/last_edits"),
+            "route.all": route("/all"),
+            "route.search": route("/search?query=" + WORDS[0]),
+            "route.random": route("/random")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--revisions", type=int, default=10, help="revisions per page")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs of each benchmark")
+    parser.add_argument("--only", help="only run the benchmarks whose name starts with this")
+    parser.add_argument("--output", default="benchmark.json", help="where the JSON results are written")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative change of the median under which a benchmark is unchanged")
+    args = parser.parse_args()
+
+    # the in-memory database, and the search backend that doesn't need MongoDB's text indexes
+    models._client, models._client_pid = mongomock.MongoClient(), os.getpid()
+    # mongomock can't create capped collections, the recent edits feed is an ordinary one here
+    models._recent_edits_checked = True
+    search._backend = search.InvertedIndexSearch(folder=tempfile.mkdtemp(prefix="wikiloult-bench-"))
+
+    wiki = GeneratedWiki(args.pages, args.revisions, args.users, args.seed)
+    start = time.perf_counter()
+    wiki.populate()
+    print("wiki generated in %.1fs" % (time.perf_counter() - start))
+
+    markdown_samples = [wiki.markdown() for _ in range(20)]
+    results = {"date": datetime.datetime.utcnow().isoformat(),
+               "python": platform.python_version(),
+               "parameters": {"pages": args.pages, "revisions": args.revisions, "users": args.users,
+                              "seed": args.seed, "repeat": args.repeat},
+               "results": {}}
+    for name, func in benchmarks(wiki, markdown_samples).items():
+        if args.only and not name.startswith(args.only):
+            continue
+        results["results"][name] = measure(func, args.repeat)
+        print("%-35s %9.3f ms" % (name, results["results"][name]["median_ms"]))
+
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        if regressions:
+            sys.exit("slower than the baseline: " + ", ".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""Per-request cost of building the users of a 500-revision history page, with and without
+the identity cache. Doesn't need a database."""
+import argparse
+import timeit
+
+from tools.users import User, derive_identity
+
+
+def build_user_list(cookies):
+    return [User(cookie) for cookie in cookies]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--revisions", type=int, default=500)
+    parser.add_argument("--editors", type=int, default=12, help="number of distinct editors of the page")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    cookies = ["editor-%d" % (i % args.editors) for i in range(args.revisions)]
+
+    def uncached():
+        # what User() used to do: everything derived again for each revision
+        for cookie in cookies:
+            derive_identity.__wrapped__(cookie)
+
+    def cold_cache():
+        derive_identity.cache_clear()
+        build_user_list(cookies)
+
+    def warm_cache():
+        build_user_list(cookies)
+
+    for name, func in (("no cache", uncached), ("cold cache", cold_cache), ("warm cache", warm_cache)):
+        func()
+        duration = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print("%-12s %8.3f ms per request" % (name, duration * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,99 @@
+from os import path
+
 # Addresse de la base de données.
 
 DB_ADDRESS = "mongodb://localhost:27017/"
 PAGES_COLLECTION_NAME = "pages"
 USERS_COLLECTION_NAME = "users"
+REVISIONS_COLLECTION_NAME = "revisions"
+RECENT_EDITS_COLLECTION_NAME = "recent_edits"
+META_COLLECTION_NAME = "meta"
+RATE_LIMITS_COLLECTION_NAME = "rate_limits"
 SECRET_KEY = "this the secret key"
 
+# Connection pool shared by all the connectors of a process
+DB_MAX_POOL_SIZE = 50
+DB_MIN_POOL_SIZE = 0
+DB_MAX_IDLE_TIME_MS = 60000
+DB_CONNECT_TIMEOUT_MS = 5000
+DB_SOCKET_TIMEOUT_MS = 10000
+DB_SERVER_SELECTION_TIMEOUT_MS = 5000
+
+# Number of rendered markdown documents kept in memory by each process
+RENDER_CACHE_SIZE = 512
+
+# Number of revisions per page of a wiki page's history
+HISTORY_PAGE_SIZE = 20
+ALL_PAGES_PAGE_SIZE = 200
+# Template output events buffered before a chunk of a streamed page is sent
+STREAM_BUFFER_SIZE = 50
+# Number of edits kept in each user's log, and shown on their page
+USER_MODIFICATIONS_LOG_SIZE = 100
+USER_PAGE_MODIFICATIONS = 15
+
+# Revisions are stored as deltas, with a full copy of the page every N revisions
+REVISION_SNAPSHOT_INTERVAL = 20
+
+# Number of revisions looked at to list a page's last editors
+CONDENSED_HISTORY_SIZE = 50
+
+# Bounds of the capped collection feeding the last edits page
+RECENT_EDITS_MAX_COUNT = 1000
+RECENT_EDITS_MAX_SIZE = 4 * 1024 * 1024
+
+# Number of users whose pokémon identity is kept in memory by each process
+USER_CACHE_SIZE = 1024
+# Seconds during which a user's registration and edit authorization are kept in memory by each
+# process, 0 to look them up on each request. A change made from the admin is seen at once by the
+# process that served it, and after this delay by the others.
+USER_STATE_CACHE_TTL = 0
+
+# Background synthesis of the pages' title audio
+AUDIO_RENDER_WORKERS = 2
+AUDIO_RENDER_RETRIES = 2
+# Seconds before a title whose audio couldn't be rendered is tried again
+AUDIO_RENDER_FAILURE_BACKOFF = 3600
+# "wav", or "ogg"/"mp3" for compressed files (needs ffmpeg)
+AUDIO_FORMAT = "wav"
+# Unused audio files are deleted when the audio folder grows over this size (in bytes)
+AUDIO_CACHE_MAX_SIZE = 500 * 1024 * 1024
+
+# Number of search results per page
+SEARCH_PAGE_SIZE = 20
+# Results past this many pages aren't served
+SEARCH_MAX_PAGES = 50
+# "mongo" to use MongoDB's text index, "inverted_index" for the wiki's own search index
+SEARCH_BACKEND = "mongo"
+# The inverted index's journal of updates is merged into the index past this size (in bytes)
+SEARCH_JOURNAL_MAX_SIZE = 1024 * 1024
+
+# Seconds after which the list of pages /random picks from is reloaded
+RANDOM_PAGES_REFRESH_INTERVAL = 300
+
+# Seconds a reverse proxy can serve the pages seen by anonymous visitors without revalidating them
+HTTP_CACHE_MAX_AGE = 60
+
+# Rendered page bodies kept in memory by each process
+FRAGMENT_CACHE_SIZE = 256
+# Cache shared by the workers for the page bodies: None, or a redis:// URL
+FRAGMENT_CACHE_SHARED_URL = None
+FRAGMENT_CACHE_SHARED_TTL = 24 * 3600
+
+# Timings of the requests, MongoDB commands, rendering and audio synthesis, shown on the
+# admin's /admin/metrics in Prometheus' format. Off by default, as it costs a little on each request.
+METRICS_ENABLED = False
+METRICS_SLOW_QUERY_MS = 100
+METRICS_SLOW_QUERIES_KEPT = 50
+
+# Where the rate limits' counters are kept: "wikiloult+mongodb://" (the wiki's database),
+# "wikiloult+sqlite:////path/to/file.sqlite" (a single host), or any storage URI flask-limiter
+# supports. "memory://" keeps them in each worker, the limits are then per worker.
+RATELIMIT_STORAGE_URI = "wikiloult+mongodb://"
+
+# Where `manage.py backup` writes the archives (and the checkpoint of the incremental ones), and
+# the documents read from the database, or written to it on restore, at a time
+BACKUPS_FOLDER = path.expanduser("~/db_backups")
+BACKUP_BATCH_SIZE = 1000
+
 # Here set the cookies of the admins, in their raw form
 ADMIN_COOKIES = ["wiki"]
@@ -0,0 +1,128 @@
+"""Administration commands for the wiki. Run them from the src/ folder: python manage.py <command>"""
+import argparse
+
+from config import AUDIO_CACHE_MAX_SIZE, BACKUPS_FOLDER
+from tools import migrations
+from tools import backup
+from tools.audio import audio_filename, evict_orphaned_audio
+from tools.export import EXPORT_FOLDER, export_static
+from tools.models import WikiPagesConnector
+from tools.search import InvertedIndexSearch
+from tools.tables import load_sources, write_tables
+
+
+def migrate_revisions(args):
+    """Moves the pages' history to the revisions collection"""
+    print("%d pages migrated" % migrations.migrate_page_history())
+
+
+def backfill_recent_edits(args):
+    """Rebuilds the recent edits feed from the revisions"""
+    print("%d edits added to the feed" % migrations.backfill_recent_edits())
+
+
+def backfill_page_fields(args):
+    """Computes the pages' precomputed fields"""
+    print("%d pages updated" % migrations.backfill_page_fields())
+
+
+def backfill_user_fields(args):
+    """Computes the users' precomputed fields"""
+    print("%d users updated" % migrations.backfill_user_fields())
+
+
+def trim_user_modifications(args):
+    """Only keeps the USER_MODIFICATIONS_LOG_SIZE last edits of each user"""
+    print("%d users updated" % migrations.trim_user_modifications())
+
+
+def evict_audio(args):
+    """Deletes the audio files no page uses anymore, if the audio folder is too big"""
+    page_cnctr = WikiPagesConnector()
+    referenced = {audio_filename(page_data["title"]) for page_data in page_cnctr.pages.find({}, {"title": 1})}
+    print("%d audio files deleted" % evict_orphaned_audio(referenced, args.max_size))
+
+
+def rebuild_search_index(args):
+    """Builds the inverted search index from scratch"""
+    print("%d pages indexed" % InvertedIndexSearch().rebuild(WikiPagesConnector().pages))
+
+
+def export_static_site(args):
+    """Exports the wiki as static HTML, only rendering the pages edited since the last export"""
+    exported, deleted = export_static(args.output, args.workers, args.full)
+    print("%d pages exported, %d deleted" % (exported, deleted))
+
+
+def build_identity_tables(args):
+    """Packs the word lists the users' identities are picked from (done on first use otherwise)"""
+    write_tables(load_sources())
+
+
+def backup_database(args):
+    """Backs the database up to a compressed archive, only what's new since the last backup if --incremental"""
+    print("database backed up to %s" % backup.backup(args.folder, args.incremental))
+
+
+def restore_database(args):
+    """Loads a backup archive into the database"""
+    for collection_name, count in backup.restore(args.archive, args.drop).items():
+        print("%s: %d documents restored" % (collection_name, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    migrate_revisions_parser = subparsers.add_parser("migrate-revisions", help=migrate_revisions.__doc__)
+    migrate_revisions_parser.set_defaults(func=migrate_revisions)
+
+    backfill_recent_edits_parser = subparsers.add_parser("backfill-recent-edits", help=backfill_recent_edits.__doc__)
+    backfill_recent_edits_parser.set_defaults(func=backfill_recent_edits)
+
+    backfill_page_fields_parser = subparsers.add_parser("backfill-page-fields", help=backfill_page_fields.__doc__)
+    backfill_page_fields_parser.set_defaults(func=backfill_page_fields)
+
+    backfill_user_fields_parser = subparsers.add_parser("backfill-user-fields", help=backfill_user_fields.__doc__)
+    backfill_user_fields_parser.set_defaults(func=backfill_user_fields)
+
+    trim_modifications_parser = subparsers.add_parser("trim-user-modifications", help=trim_user_modifications.__doc__)
+    trim_modifications_parser.set_defaults(func=trim_user_modifications)
+
+    evict_audio_parser = subparsers.add_parser("evict-audio", help=evict_audio.__doc__)
+    evict_audio_parser.add_argument("--max-size", type=int, default=AUDIO_CACHE_MAX_SIZE,
+                                    help="size of the audio folder to stay under, in bytes")
+    evict_audio_parser.set_defaults(func=evict_audio)
+
+    rebuild_search_index_parser = subparsers.add_parser("rebuild-search-index", help=rebuild_search_index.__doc__)
+    rebuild_search_index_parser.set_defaults(func=rebuild_search_index)
+
+    export_static_parser = subparsers.add_parser("export-static", help=export_static_site.__doc__)
+    export_static_parser.add_argument("--output", default=EXPORT_FOLDER, help="folder the site is exported to")
+    export_static_parser.add_argument("--workers", type=int, default=None,
+                                      help="processes rendering the pages, one per CPU by default")
+    export_static_parser.add_argument("--full", action="store_true", help="export all the pages again")
+    export_static_parser.set_defaults(func=export_static_site)
+
+    build_identity_tables_parser = subparsers.add_parser("build-identity-tables", help=build_identity_tables.__doc__)
+    build_identity_tables_parser.set_defaults(func=build_identity_tables)
+
+    backup_parser = subparsers.add_parser("backup", help=backup_database.__doc__)
+    backup_parser.add_argument("--folder", default=BACKUPS_FOLDER, help="folder the archive is written to")
+    backup_parser.add_argument("--incremental", action="store_true",
+                               help="only save the pages, users and revisions new since the last backup")
+    backup_parser.set_defaults(func=backup_database)
+
+    restore_parser = subparsers.add_parser("restore", help=restore_database.__doc__)
+    restore_parser.add_argument("archive", help="archive written by the backup command")
+    restore_parser.add_argument("--drop", action="store_true",
+                                help="empty the collections first, instead of replacing the saved documents")
+    restore_parser.set_defaults(func=restore_database)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
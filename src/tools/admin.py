@@ -1,62 +1,110 @@
-from operator import itemgetter
+import datetime
 
 from flask_admin.contrib.pymongo import ModelView
 from flask_admin import expose, AdminIndexView
 from wtforms import form, fields
 
 from config import ADMIN_COOKIES
-from tools.models import UsersConnector
+from tools.models import UsersConnector, WikiPagesConnector, page_index_fields, invalidate_random_pages, \
+    invalidate_user_state
+from .fragments import get_fragment_cache
+from . import metrics
+from .search import get_search_backend
 from .users import User
 import flask_login as login
-from flask import redirect, url_for, abort
+from flask import redirect, url_for, abort, Response
 
 class UserForm(form.Form):
     is_allowed = fields.BooleanField('Is Allowed')
     _id = fields.StringField("User cookie")
 
 
-class UserView(ModelView):
+class ProjectedCollection:
+    """Wraps a collection so that the admin's list queries only load the listed columns.
+    Single documents (for the edit forms) are still loaded whole."""
+
+    def __init__(self, collection, projection: dict):
+        self.collection = collection
+        self.projection = projection
+
+    def find(self, *args, **kwargs):
+        kwargs.setdefault("projection", self.projection)
+        return self.collection.find(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+class ProjectedModelView(ModelView):
+
+    def __init__(self, coll, *args, **kwargs):
+        projection = {column: 1 for column in self.column_list}
+        super().__init__(ProjectedCollection(coll, projection), *args, **kwargs)
+
+
+class UserView(ProjectedModelView):
+    # the pokemon name is stored when the user registers
     column_list = ('poke_name', 'is_allowed', 'registration_date')
     column_sortable_list = ('is_allowed', 'registration_date')
 
     form = UserForm
 
-    def get_list(self, *args, **kwargs):
-        """Using the user's cookie to compute the actual pokemon name"""
-        count, data = super().get_list(*args, **kwargs)
-        for item in data:
-            user_obj = User(item["_id"])
-            item["poke_name"] = user_obj.poke_params.pokename + " " + user_obj.poke_params.poke_adj
-        return count, data
+    def on_model_change(self, form, model, is_created):
+        model["poke_name"] = User(model["_id"]).poke_name
+
+    def after_model_change(self, form, model, is_created):
+        invalidate_user_state(model["_id"])
+
+    def after_model_delete(self, model):
+        invalidate_user_state(model["_id"])
 
 
 class PageForm(form.Form):
     _id = fields.StringField("Page Name")
     title = fields.StringField("Title")
 
-class PageView(ModelView):
+class PageView(ProjectedModelView):
+    # the last editor is stored along with the page on each edit
     column_list = ("_id", "title", "last_edit", "creation_date", "last_editor")
     form = PageForm
 
-    def get_list(self, *args, **kwargs):
-        """Mostly just to get the last editor"""
-        count, data = super().get_list(*args, **kwargs)
-        for item in data:
-            sorted_by_date = sorted(item["history"], key=itemgetter('edition_time'))
-            last_editor = User(sorted_by_date[0]["editor_cookie"])
-            item["last_editor"] = last_editor.poke_params.pokename + " " + last_editor.poke_params.poke_adj
+    def on_model_change(self, form, model, is_created):
+        model.update(page_index_fields(model["title"]))
+        # a change of title is a change of the page, for the HTTP validators, the static export
+        # and the incremental backups
+        model["last_edit"] = datetime.datetime.utcnow()
+
+    def after_model_change(self, form, model, is_created):
+        WikiPagesConnector().bump_version()
+        get_fragment_cache().invalidate(model["_id"])
+        get_search_backend().update_page(model["_id"], model["title"], model.get("raw_text", ""))
+
+    def on_model_delete(self, model):
+        WikiPagesConnector().delete_revisions(model["_id"])
 
-        return count, data
+    def after_model_delete(self, model):
+        WikiPagesConnector().bump_version()
+        get_fragment_cache().invalidate(model["_id"])
+        invalidate_random_pages()
+        get_search_backend().remove_page(model["_id"])
 
 
 class CheckCookieAdminView(AdminIndexView):
 
-    @expose('/')
-    def index(self):
+    def check_admin(self):
         if not login.current_user.is_authenticated:
             return redirect(url_for('login'))
 
         if login.current_user.cookie not in ADMIN_COOKIES:
             abort(403)
 
-        return super().index()
\ No newline at end of file
+    @expose('/')
+    def index(self):
+        return self.check_admin() or super().index()
+
+    @expose('/metrics')
+    def metrics(self):
+        """The hot paths' timings, for Prometheus"""
+        if not metrics.METRICS_ENABLED:
+            abort(404)
+        return self.check_admin() or Response(metrics.exposition(), mimetype="text/plain; version=0.0.4")
\ No newline at end of file
@@ -0,0 +1,134 @@
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+import json
+import logging
+from os import getpid, makedirs, replace, remove, scandir
+from os.path import exists, dirname, basename, join, realpath
+import threading
+import time
+
+from config import AUDIO_FORMAT, AUDIO_RENDER_FAILURE_BACKOFF
+from .rendering import audio_render, normalize_audio_text, AUDIO_VOICE
+
+logger = logging.getLogger(__name__)
+
+AUDIO_FOLDER = join(dirname(dirname(realpath(__file__))), "static", "sound")
+TMP_PREFIX = ".tmp-"
+
+
+def audio_filename(text: str) -> str:
+    """Content-addressed name of a text's audio file: a title is only synthesized again if its
+    pronounced text, the voice or the format changed, and pages with the same title share a file"""
+    key = json.dumps([normalize_audio_text(text), AUDIO_VOICE, AUDIO_FORMAT], sort_keys=True)
+    return sha1(key.encode("utf8")).hexdigest()[:24] + "." + AUDIO_FORMAT
+
+
+def audio_path(text: str) -> str:
+    return join(AUDIO_FOLDER, audio_filename(text))
+
+
+def evict_orphaned_audio(referenced_filenames: set, max_size: int, folder: str = AUDIO_FOLDER):
+    """Deletes audio files that no page uses anymore, oldest first, until the folder weighs
+    less than `max_size` bytes. Returns the number of deleted files."""
+    if not exists(folder):
+        return 0
+    files = [entry for entry in scandir(folder) if entry.is_file() and not entry.name.startswith(TMP_PREFIX)]
+    total_size = sum(entry.stat().st_size for entry in files)
+    orphans = sorted((entry for entry in files if entry.name not in referenced_filenames),
+                     key=lambda entry: entry.stat().st_mtime)
+    deleted = 0
+    for entry in orphans:
+        if total_size <= max_size:
+            break
+        total_size -= entry.stat().st_size
+        remove(entry.path)
+        deleted += 1
+    return deleted
+
+
+class AudioRenderQueue:
+    """Renders the pages' title audio in a bounded pool of background threads.
+
+    Jobs are de-duplicated per output file: submitting a file that's already waiting only
+    updates its text, and a file submitted while it's being rendered is rendered again
+    with the newest text once the current render is done. A file whose render failed isn't
+    submitted again before `failure_backoff` seconds."""
+
+    PENDING = "pending"
+    FAILED = "failed"
+    DONE = "done"
+
+    def __init__(self, max_workers: int, max_retries: int, retry_delay: float = 1.0,
+                 failure_backoff: float = AUDIO_RENDER_FAILURE_BACKOFF):
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.failure_backoff = failure_backoff
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="audio-render")
+        self._lock = threading.Lock()
+        self._waiting = {}  # render path -> text of the latest request
+        self._running = set()
+        self._failed = {}  # render path -> time of the last failed render
+
+    def submit(self, text: str, render_path: str):
+        if exists(render_path):
+            # the file name is a hash of what it contains, it's already up to date
+            return
+        with self._lock:
+            failed_at = self._failed.get(render_path)
+            if failed_at is not None:
+                if time.monotonic() - failed_at < self.failure_backoff:
+                    return
+                del self._failed[render_path]
+            already_scheduled = render_path in self._waiting or render_path in self._running
+            self._waiting[render_path] = text
+        if not already_scheduled:
+            self._executor.submit(self._run, render_path)
+
+    def status(self, render_path: str):
+        """DONE if the file can be served, else PENDING or FAILED for a submitted file, None otherwise"""
+        if exists(render_path):
+            return self.DONE
+        with self._lock:
+            if render_path in self._waiting or render_path in self._running:
+                return self.PENDING
+            if render_path in self._failed:
+                return self.FAILED
+        return None
+
+    def is_ready(self, render_path: str) -> bool:
+        """The file can be served (possibly an older version if a new one is on its way)"""
+        return exists(render_path)
+
+    def _run(self, render_path: str):
+        while True:
+            with self._lock:
+                text = self._waiting.pop(render_path, None)
+                if text is None:
+                    self._running.discard(render_path)
+                    return
+                self._running.add(render_path)
+
+            if not self._render(text, render_path):
+                with self._lock:
+                    self._failed[render_path] = time.monotonic()
+
+    def _render(self, text: str, render_path: str) -> bool:
+        makedirs(dirname(render_path), exist_ok=True)
+        # rendered next to the final file then moved, so a half-written file is never served. The
+        # jobs are only de-duplicated within a process, other workers may be rendering it too
+        tmp_path = join(dirname(render_path), "%s%d-%s" % (TMP_PREFIX, getpid(), basename(render_path)))
+        for attempt in range(self.max_retries + 1):
+            try:
+                audio_render(text, tmp_path)
+                replace(tmp_path, render_path)
+                return True
+            except Exception:
+                logger.exception("Audio render of %s failed (attempt %d)", render_path, attempt + 1)
+                if attempt < self.max_retries:
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        if exists(tmp_path):
+            remove(tmp_path)
+        return False
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
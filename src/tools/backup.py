@@ -0,0 +1,128 @@
+"""Backups of the wiki's database, streamed from the collections straight into a zip archive
+holding one NDJSON file (MongoDB extended JSON, one document per line) per collection, and
+their restoration.
+
+An incremental backup only holds the pages edited, the users registered and the revisions
+made since the previous backup, plus the small collections in full. Restoring a full backup
+then the incremental ones made after it, in order, gives the database as of the last one,
+except for the pages deleted and the users changed (authorization, profile) in between: only
+full backups catch those."""
+import datetime
+import io
+import json
+import os
+from os.path import exists, join
+import zipfile
+
+from bson import json_util
+from pymongo import InsertOne, ReplaceOne
+
+from config import PAGES_COLLECTION_NAME, USERS_COLLECTION_NAME, REVISIONS_COLLECTION_NAME, \
+    RECENT_EDITS_COLLECTION_NAME, META_COLLECTION_NAME, BACKUP_BATCH_SIZE
+from .models import WikiPagesConnector, invalidate_random_pages
+
+MANIFEST_NAME = "manifest.json"
+CHECKPOINT_NAME = "checkpoint.json"
+# the date field telling what's new for an incremental backup, None for the collections that
+# are always saved whole
+BACKED_UP_COLLECTIONS = {PAGES_COLLECTION_NAME: "last_edit",
+                         USERS_COLLECTION_NAME: "registration_date",
+                         REVISIONS_COLLECTION_NAME: "edition_time",
+                         RECENT_EDITS_COLLECTION_NAME: None,
+                         META_COLLECTION_NAME: None}
+# extended JSON that keeps the types as they are (dates, 64 bits integers...)
+JSON_OPTIONS = json_util.CANONICAL_JSON_OPTIONS
+
+
+def read_checkpoint(folder: str):
+    """The start date of the last backup made in the folder, None if there's none"""
+    checkpoint_path = join(folder, CHECKPOINT_NAME)
+    if not exists(checkpoint_path):
+        return None
+    with open(checkpoint_path) as checkpoint_file:
+        return datetime.datetime.fromisoformat(json.load(checkpoint_file)["last_backup"])
+
+
+def write_checkpoint(folder: str, backup_start: datetime.datetime):
+    with open(join(folder, CHECKPOINT_NAME), "w") as checkpoint_file:
+        json.dump({"last_backup": backup_start.isoformat()}, checkpoint_file)
+
+
+def backup(folder: str, incremental: bool = False) -> str:
+    """Backs the database up to a new archive in `folder`, returns its path. An incremental
+    backup without a previous one is a full one."""
+    os.makedirs(folder, exist_ok=True)
+    # taken before reading anything, so what's written during the backup is in the next one. The
+    # database keeps dates to the millisecond: a document written in the same millisecond as the
+    # start is dated exactly that, hence the floor and the $gte (saving it twice is harmless)
+    start = datetime.datetime.utcnow()
+    start = start.replace(microsecond=start.microsecond // 1000 * 1000)
+    since = read_checkpoint(folder) if incremental else None
+    archive_name = "wikiloult-%s%s.zip" % (start.strftime("%Y-%m-%d-%H%M%S"), "-incremental" if since else "")
+    archive_path = join(folder, archive_name)
+    tmp_path = archive_path + ".tmp"
+
+    db = WikiPagesConnector().db
+    manifest = {"created": start.isoformat(),
+                "since": since.isoformat() if since else None,
+                "collections": {}}
+    with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for collection_name, date_field in BACKED_UP_COLLECTIONS.items():
+            query = {date_field: {"$gte": since}} if since and date_field else {}
+            # in natural order: the recent edits feed is read in insertion order
+            cursor = db[collection_name].find(query).sort("$natural", 1).batch_size(BACKUP_BATCH_SIZE)
+            count = 0
+            with archive.open(collection_name + ".ndjson", "w", force_zip64=True) as entry:
+                for document in cursor:
+                    entry.write(json_util.dumps(document, json_options=JSON_OPTIONS).encode("utf8") + b"\n")
+                    count += 1
+            manifest["collections"][collection_name] = count
+        archive.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+
+    os.replace(tmp_path, archive_path)
+    write_checkpoint(folder, start)
+    return archive_path
+
+
+def read_documents(archive: zipfile.ZipFile, collection_name: str):
+    with archive.open(collection_name + ".ndjson") as entry:
+        for line in io.TextIOWrapper(entry, encoding="utf8"):
+            if line.strip():
+                yield json_util.loads(line, json_options=JSON_OPTIONS)
+
+
+def restore(archive_path: str, drop: bool = False) -> dict:
+    """Loads an archive into the database, by batches of BACKUP_BATCH_SIZE documents. The
+    documents replace those with the same id, unless `drop` empties the collections first.
+    Returns the number of documents restored per collection."""
+    page_cnctr = WikiPagesConnector()
+    restored = {}
+    with zipfile.ZipFile(archive_path) as archive:
+        manifest = json.loads(archive.read(MANIFEST_NAME))
+        for collection_name in manifest["collections"]:
+            collection = page_cnctr.db[collection_name]
+            # the recent edits feed is a capped collection, always saved whole
+            replace = not drop and collection_name != RECENT_EDITS_COLLECTION_NAME
+            if collection_name == RECENT_EDITS_COLLECTION_NAME:
+                page_cnctr.create_recent_edits_collection()
+            elif drop:
+                # emptied rather than dropped, the indexes stay
+                collection.delete_many({})
+
+            batch, count = [], 0
+            for document in read_documents(archive, collection_name):
+                batch.append(ReplaceOne({"_id": document["_id"]}, document, upsert=True) if replace
+                             else InsertOne(document))
+                if len(batch) == BACKUP_BATCH_SIZE:
+                    collection.bulk_write(batch, ordered=False)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                collection.bulk_write(batch, ordered=False)
+                count += len(batch)
+            restored[collection_name] = count
+    # the caches built from the pages collection have to be rebuilt (the fragments are stamped
+    # with their page's revision, they don't)
+    page_cnctr.bump_version()
+    invalidate_random_pages()
+    return restored
@@ -0,0 +1,59 @@
+"""HTTP caching: validators for conditional GETs, and the Cache-Control headers letting a
+reverse proxy cache what anonymous visitors see"""
+import datetime
+from hashlib import sha1
+
+from flask import request, make_response
+from flask_login import current_user
+
+from config import HTTP_CACHE_MAX_AGE
+
+
+def _user_state() -> str:
+    # the header of every page shows who's logged in. The id is the salted hash of the cookie:
+    # the cookie itself is the user's password, and ETags are sent in the clear
+    return current_user.user_id if current_user.is_authenticated else "anonymous"
+
+
+def make_etag(*validators) -> str:
+    """ETag of a view whose content only depends on the validators and on who's looking at it"""
+    return sha1(repr((_user_state(),) + validators).encode("utf8")).hexdigest()
+
+
+def _as_http_date(date: datetime.datetime) -> datetime.datetime:
+    # dates from MongoDB are naive UTC, HTTP dates have a one second resolution
+    return date.replace(tzinfo=datetime.timezone.utc, microsecond=0)
+
+
+def is_not_modified(etag: str, last_modified: datetime.datetime = None) -> bool:
+    """Tells if the client's copy is still fresh, per the request's If-None-Match, or its
+    If-Modified-Since if there's no If-None-Match"""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        # a login or logout doesn't change the date, so only anonymous views use it
+        return not current_user.is_authenticated \
+            and _as_http_date(last_modified) <= request.if_modified_since
+    return False
+
+
+def cacheable(response, etag: str, last_modified: datetime.datetime = None):
+    """Adds the validators and Cache-Control headers to a response"""
+    response = make_response(response)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = _as_http_date(last_modified)
+    response.vary.add("Cookie")
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        # shared caches can serve it for a while, then have to revalidate
+        response.cache_control.public = True
+        response.cache_control.max_age = 0
+        response.cache_control.s_maxage = HTTP_CACHE_MAX_AGE
+    return response
+
+
+def not_modified_response(etag: str, last_modified: datetime.datetime = None):
+    return cacheable(("", 304), etag, last_modified)
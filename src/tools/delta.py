@@ -0,0 +1,37 @@
+"""Line-based deltas between two versions of a page's markdown.
+
+A delta is a list of operations applied in order on the lines of the previous version:
+a positive int copies that many lines, a negative int skips that many lines, and a string
+is inserted as is. It's plain BSON, and small when an edit only touches a few lines."""
+from difflib import SequenceMatcher
+
+
+def make_delta(old_text: str, new_text: str) -> list:
+    old_lines = old_text.splitlines(keepends=True)
+    new_lines = new_text.splitlines(keepends=True)
+    delta = []
+    matcher = SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+        if tag == "equal":
+            delta.append(old_end - old_start)
+            continue
+        if old_end > old_start:
+            delta.append(old_start - old_end)
+        if new_end > new_start:
+            delta.append("".join(new_lines[new_start:new_end]))
+    return delta
+
+
+def apply_delta(old_text: str, delta: list) -> str:
+    old_lines = old_text.splitlines(keepends=True)
+    position = 0
+    output = []
+    for operation in delta:
+        if isinstance(operation, str):
+            output.append(operation)
+        elif operation > 0:
+            output.extend(old_lines[position:position + operation])
+            position += operation
+        else:
+            position -= operation
+    return "".join(output)
@@ -0,0 +1,127 @@
+"""Export of the wiki as static HTML files, for the front proxy to serve to anonymous visitors.
+
+The files mirror the site's URLs: ``page/<name>/index.html``, ``all/index.html``,
+``last_edits/index.html`` and ``sound/<file>`` (the assets of ``static/`` are served as they
+are). A manifest keeps each exported page's last edit, so that later exports only render the
+pages that changed since, and the index pages if any did."""
+from concurrent.futures import ProcessPoolExecutor
+import fcntl
+import json
+import os
+from os.path import dirname, exists, join, realpath
+import shutil
+
+from .audio import AudioRenderQueue, audio_filename, audio_path
+from .models import WikiPagesConnector
+
+EXPORT_FOLDER = join(dirname(dirname(realpath(__file__))), "static_export")
+MANIFEST_NAME = "manifest.json"
+# pages handed to a worker at once
+BATCH_SIZE = 50
+
+
+def write_file(file_path: str, content: str):
+    """Writes to a temporary file first, so the proxy never serves half a page"""
+    os.makedirs(dirname(file_path), exist_ok=True)
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "w") as output_file:
+        output_file.write(content)
+    os.replace(tmp_path, file_path)
+
+
+def page_folder(output_folder: str, page_name: str) -> str:
+    return join(output_folder, "page", page_name)
+
+
+def is_exportable(page_name: str) -> bool:
+    # these names can't be folder names, those pages are left to the app
+    return page_name not in ("", ".", "..") and os.sep not in page_name
+
+
+def manifest_entry(page_data: dict) -> list:
+    # a page is exported again if it was edited, or if its audio got ready since
+    return [page_data["last_edit"].isoformat(), exists(audio_path(page_data["title"]))]
+
+
+def render_pages(page_names, output_folder: str):
+    """Exports the pages and their audio, returns the manifest entries of the exported ones.
+    Runs in the pool's workers."""
+    # the app is only needed (and imported) in the workers
+    from flask import render_template
+    from app import app
+
+    page_cnctr = WikiPagesConnector()
+    exported = {}
+    for page_name in page_names:
+        with app.test_request_context("/page/" + page_name):
+            page_data = page_cnctr.get_page_data(page_name)
+            if page_data is None:
+                continue
+            entry = manifest_entry(page_data)
+            audio_ready = entry[1]
+            html = render_template("wiki_page.html",
+                                   page_data=page_data,
+                                   page_fragment=render_template("wiki_page_content.html", page_data=page_data),
+                                   page_name=page_name,
+                                   audio_filename=audio_filename(page_data["title"]),
+                                   audio_status=AudioRenderQueue.DONE if audio_ready else None)
+        write_file(join(page_folder(output_folder, page_name), "index.html"), html)
+        if audio_ready:
+            sound_path = join(output_folder, "sound", audio_filename(page_data["title"]))
+            if not exists(sound_path):
+                os.makedirs(dirname(sound_path), exist_ok=True)
+                shutil.copyfile(audio_path(page_data["title"]), sound_path)
+        exported[page_name] = entry
+    return exported
+
+
+def render_index_pages(output_folder: str):
+    from flask import render_template
+    from app import app, last_edited_pages
+
+    page_cnctr = WikiPagesConnector()
+    with app.test_request_context("/all"):
+        write_file(join(output_folder, "all", "index.html"),
+                   render_template("all_pages.html", pages_per_first_letter=page_cnctr.iter_pages_sorted()))
+    with app.test_request_context("/last_edits"):
+        write_file(join(output_folder, "last_edits", "index.html"),
+                   render_template("last_edited.html", results_list=last_edited_pages(page_cnctr)))
+
+
+def export_static(output_folder: str = EXPORT_FOLDER, workers: int = None, full: bool = False):
+    """Exports the pages that changed since the last export (all of them if `full`), then the
+    index pages if any page changed. Returns the number of pages exported and deleted."""
+    os.makedirs(output_folder, exist_ok=True)
+    manifest_path = join(output_folder, MANIFEST_NAME)
+    with open(join(output_folder, ".lock"), "w") as lock_file:
+        # exports can be scheduled every minute, a slow one mustn't overlap the next
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError("an export is already running in " + output_folder)
+
+        manifest = {}
+        if exists(manifest_path) and not full:
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+
+        page_cnctr = WikiPagesConnector()
+        current = {page_data["_id"]: page_data for page_data in page_cnctr.pages.find({}, {"last_edit": 1,
+                                                                                           "title": 1})}
+        to_export = [page_name for page_name, page_data in current.items()
+                     if is_exportable(page_name) and manifest.get(page_name) != manifest_entry(page_data)]
+        to_delete = [page_name for page_name in manifest if page_name not in current]
+
+        batches = [to_export[i:i + BATCH_SIZE] for i in range(0, len(to_export), BATCH_SIZE)]
+        if batches:
+            with ProcessPoolExecutor(workers) as executor:
+                for exported in executor.map(render_pages, batches, [output_folder] * len(batches)):
+                    manifest.update(exported)
+        for page_name in to_delete:
+            shutil.rmtree(page_folder(output_folder, page_name), ignore_errors=True)
+            del manifest[page_name]
+
+        if to_export or to_delete or not exists(join(output_folder, "all", "index.html")):
+            render_index_pages(output_folder)
+        write_file(manifest_path, json.dumps(manifest))
+    return len(to_export), len(to_delete)
@@ -0,0 +1,102 @@
+"""Cache of the rendered body of the wiki pages (their content and last editors), which
+doesn't depend on who's looking at them. It has two tiers: an LRU in each process, and an
+optional one shared by all the workers, so a page is rendered once after an edit rather
+than once per worker.
+
+Entries are stamped with the page's revision: an outdated entry is never served, even if
+its invalidation didn't reach some worker's LRU."""
+import json
+
+from config import FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_SHARED_URL, FRAGMENT_CACHE_SHARED_TTL
+from .rendering import RenderCache
+
+
+class DictSharedCache:
+    """In-process stand-in for the shared tier, for tests and single worker setups"""
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, key: str):
+        return self._entries.get(key)
+
+    def set(self, key: str, value: str, ttl: int):
+        self._entries[key] = value
+
+    def delete(self, key: str):
+        self._entries.pop(key, None)
+
+
+class RedisSharedCache:
+
+    def __init__(self, url: str):
+        import redis  # only needed when the shared tier is enabled
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key: str):
+        return self._redis.get(key)
+
+    def set(self, key: str, value: str, ttl: int):
+        self._redis.set(key, value, ex=ttl)
+
+    def delete(self, key: str):
+        self._redis.delete(key)
+
+
+class FragmentCache:
+
+    def __init__(self, max_size: int, shared=None, shared_ttl: int = FRAGMENT_CACHE_SHARED_TTL):
+        self.local = RenderCache(max_size)
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+
+    @staticmethod
+    def revision_stamp(page_summary: dict) -> str:
+        # the title is in there since the admin can change it without a new revision
+        return "%s|%s|%s" % (page_summary.get("revision_count"), page_summary["last_edit"].isoformat(),
+                             page_summary["title"])
+
+    @staticmethod
+    def _shared_key(page_name: str) -> str:
+        return "wikiloult:fragment:" + page_name
+
+    def get(self, page_name: str, stamp: str):
+        entry = self.local.get(page_name)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        if self.shared is not None:
+            value = self.shared.get(self._shared_key(page_name))
+            if value is not None:
+                shared_stamp, html = json.loads(value)
+                if shared_stamp == stamp:
+                    self.local.put(page_name, (stamp, html))
+                    return html
+        return None
+
+    def put(self, page_name: str, stamp: str, html: str):
+        self.local.put(page_name, (stamp, html))
+        if self.shared is not None:
+            self.shared.set(self._shared_key(page_name), json.dumps([stamp, html]), self.shared_ttl)
+
+    def invalidate(self, page_name: str):
+        self.local.delete(page_name)
+        if self.shared is not None:
+            self.shared.delete(self._shared_key(page_name))
+
+
+def make_shared_cache(url):
+    if url is None:
+        return None
+    if url == "memory://":
+        return DictSharedCache()
+    return RedisSharedCache(url)
+
+
+_fragment_cache = None
+
+
+def get_fragment_cache() -> FragmentCache:
+    global _fragment_cache
+    if _fragment_cache is None:
+        _fragment_cache = FragmentCache(FRAGMENT_CACHE_SIZE, make_shared_cache(FRAGMENT_CACHE_SHARED_URL))
+    return _fragment_cache
@@ -0,0 +1,152 @@
+"""Timings of the hot paths: requests per route, MongoDB commands, markdown rendering, identity
+derivation and audio synthesis, exposed in Prometheus' text format on the admin's /metrics.
+
+Everything is off unless METRICS_ENABLED is set: `timed` then returns the functions untouched,
+and neither the request hooks nor the MongoDB listener are installed."""
+from collections import deque
+from functools import wraps
+import threading
+import time
+
+from pymongo import monitoring
+
+from config import METRICS_ENABLED, METRICS_SLOW_QUERY_MS, METRICS_SLOW_QUERIES_KEPT
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+
+    def __init__(self, name: str, help_text: str, buckets=DURATION_BUCKETS):
+        self.name, self.help_text, self.buckets = name, help_text, buckets
+        # labels values -> (count per bucket, sum, count)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            bucket_counts, total, count = self._series.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[i] += 1
+            self._series[key] = (bucket_counts, total + value, count + 1)
+
+    def exposition(self):
+        lines = ["# HELP %s %s" % (self.name, self.help_text), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            series = sorted((key, (list(counts), total, count)) for key, (counts, total, count)
+                            in self._series.items())
+        for key, (bucket_counts, total, count) in series:
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(key + (("le", bound),)), bucket_count))
+            lines.append("%s_bucket%s %d" % (self.name, format_labels(key + (("le", "+Inf"),)), count))
+            lines.append("%s_sum%s %f" % (self.name, format_labels(key), total))
+            lines.append("%s_count%s %d" % (self.name, format_labels(key), count))
+        return lines
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for name, value in labels)
+
+
+request_seconds = Histogram("wikiloult_request_seconds", "Time spent handling the requests, per route")
+request_mongo_seconds = Histogram("wikiloult_request_mongo_seconds",
+                                  "Time spent waiting for MongoDB during the requests, per route")
+request_mongo_commands = Histogram("wikiloult_request_mongo_commands",
+                                   "Number of MongoDB commands sent during the requests, per route", COUNT_BUCKETS)
+mongo_command_seconds = Histogram("wikiloult_mongo_command_seconds", "Duration of the MongoDB commands")
+function_seconds = Histogram("wikiloult_function_seconds", "Duration of the timed functions")
+
+# the last MongoDB commands slower than METRICS_SLOW_QUERY_MS, as (duration, command, database, route)
+slow_queries = deque(maxlen=METRICS_SLOW_QUERIES_KEPT)
+
+# MongoDB time and commands of the request being handled by the current thread
+_current_request = threading.local()
+
+
+def timed(name: str):
+    """Decorator recording the duration of each call of the function"""
+    def decorator(function):
+        if not METRICS_ENABLED:
+            return function
+
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                function_seconds.observe(time.perf_counter() - start, function=name)
+        return timed_function
+    return decorator
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Times the MongoDB commands, and adds them to the current request's totals. pymongo
+    publishes the events from the thread that sent the command."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        duration = event.duration_micros / 1e6
+        mongo_command_seconds.observe(duration, command=event.command_name)
+        route = getattr(_current_request, "route", None)
+        if route is not None:
+            _current_request.mongo_seconds += duration
+            _current_request.mongo_commands += 1
+        if duration * 1000 >= METRICS_SLOW_QUERY_MS:
+            slow_queries.append((duration, event.command_name, getattr(event, "database_name", ""), route))
+
+
+def event_listeners():
+    """The listeners to give the MongoClient"""
+    return [CommandTimer()] if METRICS_ENABLED else []
+
+
+def init_app(app):
+    """Installs the request hooks on the Flask app"""
+    if not METRICS_ENABLED:
+        return
+    from flask import request
+
+    @app.before_request
+    def start_request_timer():
+        _current_request.route = request.endpoint or "unknown"
+        _current_request.start = time.perf_counter()
+        _current_request.mongo_seconds, _current_request.mongo_commands = 0.0, 0
+
+    @app.teardown_request
+    def record_request(exception=None):
+        route = getattr(_current_request, "route", None)
+        if route is None:
+            return
+        request_seconds.observe(time.perf_counter() - _current_request.start, route=route)
+        request_mongo_seconds.observe(_current_request.mongo_seconds, route=route)
+        request_mongo_commands.observe(_current_request.mongo_commands, route=route)
+        _current_request.route = None
+
+
+def exposition() -> str:
+    """All the metrics, in Prometheus' text format"""
+    lines = []
+    for histogram in (request_seconds, request_mongo_seconds, request_mongo_commands, mongo_command_seconds,
+                      function_seconds):
+        lines.extend(histogram.exposition())
+    lines.append("# HELP wikiloult_slow_mongo_command_seconds Duration of the recent slow MongoDB commands")
+    lines.append("# TYPE wikiloult_slow_mongo_command_seconds gauge")
+    for sample, (duration, command, database, route) in enumerate(list(slow_queries)):
+        labels = (("sample", sample), ("command", command), ("database", database), ("route", route or ""))
+        lines.append("wikiloult_slow_mongo_command_seconds%s %f" % (format_labels(labels), duration))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,99 @@
+"""Data migrations, run through manage.py. They can all be run again safely."""
+from pymongo import DESCENDING
+
+from config import RECENT_EDITS_MAX_COUNT, USER_MODIFICATIONS_LOG_SIZE
+from .models import UsersConnector, WikiPagesConnector, make_revision, make_recent_edit, page_editor_fields, \
+    page_index_fields, page_text_fields
+from .users import User
+
+
+def migrate_page_history():
+    """Moves the revisions embedded in the pages' history arrays to the revisions collection.
+    Returns the number of pages migrated."""
+    page_cnctr = WikiPagesConnector()
+    migrated = 0
+    # pages with a long history can weigh several MB, hence the small batches
+    legacy_pages = page_cnctr.pages.find({"history": {"$exists": True}},
+                                         {"history": 1, "title": 1}).batch_size(10)
+    for page_data in legacy_pages:
+        history = page_data["history"]
+        # the creation entry has no title, the closest one we know is the first edit's
+        edit_title = next((entry["title"] for entry in history if "title" in entry), page_data["title"])
+        revisions = []
+        previous_markdown = None
+        for rev, entry in enumerate(history):
+            edit_title = entry.get("title", edit_title)
+            revisions.append(make_revision(page_data["_id"], rev, entry["markdown"], previous_markdown,
+                                           edit_title, entry["editor_cookie"], entry["edition_time"]))
+            previous_markdown = entry["markdown"]
+
+        # an interrupted run may have left some of the revisions behind
+        page_cnctr.delete_revisions(page_data["_id"])
+        if revisions:
+            page_cnctr.revisions.insert_many(revisions)
+        page_cnctr.pages.update_one({"_id": page_data["_id"]},
+                                    {"$unset": {"history": ""},
+                                     "$set": {"revision_count": len(revisions)}})
+        migrated += 1
+    return migrated
+
+
+def backfill_recent_edits():
+    """Rebuilds the recent edits feed from the revisions collection. Returns the number of edits
+    in the feed."""
+    page_cnctr = WikiPagesConnector()
+    last_revisions = list(page_cnctr.revisions.find({}, {"page": 1, "rev": 1, "title": 1,
+                                                         "editor_cookie": 1, "edition_time": 1})
+                          .sort([("edition_time", DESCENDING), ("rev", DESCENDING)]).limit(RECENT_EDITS_MAX_COUNT))
+    # the revisions' own content would have to be rebuilt and rendered, the snippets are
+    # made from the pages' current content instead, like the last edits page used to do
+    pages_html = {page_data["_id"]: page_data["html_content"]
+                  for page_data in page_cnctr.pages.find({"_id": {"$in": list({rev["page"] for rev in last_revisions})}},
+                                                         {"html_content": 1})}
+    page_cnctr.create_recent_edits_collection()
+    # the capped collection is read in insertion order, oldest edits go first
+    recent_edits = [make_recent_edit(rev["page"], rev["title"], pages_html[rev["page"]],
+                                     rev["editor_cookie"], rev["edition_time"])
+                    for rev in reversed(last_revisions) if rev["page"] in pages_html]
+    if recent_edits:
+        page_cnctr.recent_edits.insert_many(recent_edits)
+    return len(recent_edits)
+
+
+def backfill_page_fields():
+    """Computes the fields that the page documents keep precomputed. Returns the number of pages
+    updated."""
+    page_cnctr = WikiPagesConnector()
+    updated = 0
+    for page_data in page_cnctr.pages.find({}, {"title": 1, "html_content": 1}):
+        fields = {**page_index_fields(page_data["title"]), **page_text_fields(page_data["html_content"])}
+        last_editor_cookie = page_cnctr.get_last_editor(page_data["_id"])
+        if last_editor_cookie is not None:
+            fields.update(page_editor_fields(last_editor_cookie))
+        # the snippet the first version stored isn't used, the search results highlight their own
+        page_cnctr.pages.update_one({"_id": page_data["_id"]}, {"$set": fields, "$unset": {"snippet": ""}})
+        updated += 1
+    page_cnctr.bump_version()
+    return updated
+
+
+def backfill_user_fields():
+    """Computes the fields that the user documents keep precomputed. Returns the number of users
+    updated."""
+    users_cnctr = UsersConnector()
+    updated = 0
+    for user_data in users_cnctr.users.find({}, {"_id": 1}):
+        users_cnctr.users.update_one({"_id": user_data["_id"]},
+                                     {"$set": {"poke_name": User(user_data["_id"]).poke_name}})
+        updated += 1
+    return updated
+
+
+def trim_user_modifications():
+    """Cuts the users' edit logs down to the USER_MODIFICATIONS_LOG_SIZE last edits. Returns the
+    number of users whose log was cut."""
+    users_cnctr = UsersConnector()
+    result = users_cnctr.users.update_many(
+        {"modifications.%d" % USER_MODIFICATIONS_LOG_SIZE: {"$exists": True}},
+        {"$push": {"modifications": {"$each": [], "$slice": -USER_MODIFICATIONS_LOG_SIZE}}})
+    return result.modified_count
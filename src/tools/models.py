@@ -1,25 +1,204 @@
+import atexit
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 import datetime
+import json
+import logging
 from html import escape
-from collections import OrderedDict
-import re
-import unicodedata
+from itertools import groupby
+import os
+import random
+import threading
+import time
+from typing import NamedTuple
 
-from pymongo import MongoClient
-from config import DB_ADDRESS, USERS_COLLECTION_NAME, PAGES_COLLECTION_NAME
+from bson import ObjectId
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import CollectionInvalid
+from config import DB_ADDRESS, USERS_COLLECTION_NAME, PAGES_COLLECTION_NAME, DB_MAX_POOL_SIZE, DB_MIN_POOL_SIZE, \
+    DB_MAX_IDLE_TIME_MS, DB_CONNECT_TIMEOUT_MS, DB_SOCKET_TIMEOUT_MS, DB_SERVER_SELECTION_TIMEOUT_MS, \
+    HISTORY_PAGE_SIZE, REVISIONS_COLLECTION_NAME, REVISION_SNAPSHOT_INTERVAL, CONDENSED_HISTORY_SIZE, \
+    RECENT_EDITS_COLLECTION_NAME, RECENT_EDITS_MAX_COUNT, RECENT_EDITS_MAX_SIZE, META_COLLECTION_NAME, \
+    SEARCH_PAGE_SIZE, RANDOM_PAGES_REFRESH_INTERVAL, USER_MODIFICATIONS_LOG_SIZE, USER_PAGE_MODIFICATIONS, \
+    USER_STATE_CACHE_TTL, USER_CACHE_SIZE, ADMIN_COOKIES, ALL_PAGES_PAGE_SIZE, SEARCH_MAX_PAGES
 
+from .delta import make_delta, apply_delta
+from .fragments import get_fragment_cache
+from .metrics import event_listeners
+from .search import get_search_backend
+from .text import html_to_text, make_snippet, title_sort_key, title_first_letter, search_terms, \
+    highlight_snippet
 from .users import User
-from .rendering import WikiPageRenderer
+from .rendering import get_renderer
 
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> MongoClient:
+    """Returns the MongoClient shared by the whole process, creating it on first use.
+
+    The client is not fork-safe: a worker forked from a process that already had a
+    client (gunicorn with preload, for instance) gets a fresh one of its own."""
+    global _client, _client_pid
+    if _client is not None and _client_pid == os.getpid():
+        return _client
+
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            # connect=False: no socket nor monitor thread is opened until the first query,
+            # so importing the app in a pre-fork master stays cheap and safe
+            _client = MongoClient(DB_ADDRESS,
+                                  connect=False,
+                                  maxPoolSize=DB_MAX_POOL_SIZE,
+                                  minPoolSize=DB_MIN_POOL_SIZE,
+                                  maxIdleTimeMS=DB_MAX_IDLE_TIME_MS,
+                                  connectTimeoutMS=DB_CONNECT_TIMEOUT_MS,
+                                  socketTimeoutMS=DB_SOCKET_TIMEOUT_MS,
+                                  serverSelectionTimeoutMS=DB_SERVER_SELECTION_TIMEOUT_MS,
+                                  event_listeners=event_listeners())
+            _client_pid = os.getpid()
+    return _client
+
+
+@atexit.register
+def close_client():
+    """Closes the shared client's sockets. Called at interpreter exit, and can be
+    hooked to the WSGI server's worker exit."""
+    global _client, _client_pid
+    with _client_lock:
+        # a client inherited through a fork belongs to the parent, it's not ours to close
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client, _client_pid = None, None
+
+
+# what a token can hold besides JSON's own scalars, and how: dates as milliseconds since the epoch
+# (MongoDB's precision), ObjectIds in hexadecimal
+EPOCH = datetime.datetime(1970, 1, 1)
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {"$date": (value.replace(tzinfo=None) - EPOCH) // datetime.timedelta(milliseconds=1)}
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    raise TypeError("%r can't be put in a token" % value)
+
+
+def _decode_value(value):
+    """A value of a token as it was encoded, raises ValueError for anything encode_token doesn't
+    make: tokens come from the query string, whatever they hold ends up in queries"""
+    if isinstance(value, dict):
+        if set(value) == {"$date"} and isinstance(value["$date"], int):
+            try:
+                return EPOCH + datetime.timedelta(milliseconds=value["$date"])
+            except OverflowError:
+                raise ValueError("date out of range")
+        if set(value) == {"$oid"} and isinstance(value["$oid"], str) and ObjectId.is_valid(value["$oid"]):
+            return ObjectId(value["$oid"])
+        raise ValueError("unexpected object in a token")
+    if isinstance(value, int) and not INT64_MIN <= value <= INT64_MAX:
+        # BSON can't hold it
+        raise ValueError("integer out of range")
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    raise ValueError("unexpected value in a token")
+
+
+def encode_token(values) -> str:
+    """Opaque continuation token for a position in a listing: a value, or a list of values"""
+    return urlsafe_b64encode(json.dumps(values, default=_encode_value, separators=(",", ":"))
+                             .encode("utf8")).decode("ascii").rstrip("=")
+
+
+def decode_token(token: str):
+    """The values `encode_token` was given, or None if the token is invalid"""
+    if not token:
+        return None
+    try:
+        values = json.loads(urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        if isinstance(values, list):
+            return [_decode_value(value) for value in values]
+        return _decode_value(values)
+    except (ValueError, RecursionError):
+        # binascii.Error and JSON decoding errors are ValueErrors
+        return None
+
+
+def decode_position(token: str, fields_count: int):
+    """The values of a listing's position token, or None if it isn't a valid position"""
+    position = decode_token(token)
+    return position if isinstance(position, list) and len(position) == fields_count else None
+
+
+def decode_offset(token: str, maximum: int) -> int:
+    """A positive number held by a token, at most `maximum`, 0 if the token is invalid"""
+    offset = decode_token(token)
+    # bools are ints too
+    return min(offset, maximum) if isinstance(offset, int) and not isinstance(offset, bool) and offset > 0 else 0
+
+
+class ResultsPage(NamedTuple):
+    """A page of a listing, and the tokens of the pages before and after it (None if there are none)"""
+    items: list
+    previous_token: str
+    next_token: str
+
+
+def keyset_page(collection, query: dict, sort: list, per_page: int, projection: dict = None,
+                after: str = None, before: str = None) -> ResultsPage:
+    """One page of the documents matching `query`, in the order of `sort`, whose fields must be a
+    unique key. The page starts right after, or ends right before, the position of a token,
+    which is looked up on the index the listing is sorted on: deep pages cost as much as the
+    first one, unlike with skip()."""
+    before_position = decode_position(before, len(sort))
+    backwards = before_position is not None
+    position = before_position if backwards else decode_position(after, len(sort))
+    # a page before a position is the page after it when walking the listing backwards
+    walk = [(field, -direction if backwards else direction) for field, direction in sort]
+    conditions = dict(query)
+    if position is not None:
+        # the documents coming after the position in the (field1, field2, ...) order
+        conditions["$or"] = [dict({field: value for (field, _), value in zip(walk[:i], position)},
+                                  **{walk[i][0]: {"$gt" if walk[i][1] == ASCENDING else "$lt": position[i]}})
+                             for i in range(len(walk))]
+    # one more document tells if there's a page after this one
+    documents = list(collection.find(conditions, projection).sort(walk).limit(per_page + 1))
+    has_more = len(documents) > per_page
+    documents = documents[:per_page]
+    if backwards:
+        documents.reverse()
+
+    def token(document):
+        return encode_token([document.get(field) for field, _ in sort])
+
+    has_previous, has_next = (has_more, True) if backwards else (position is not None, has_more)
+    return ResultsPage(documents,
+                       token(documents[0]) if documents and has_previous else None,
+                       token(documents[-1]) if documents and has_next else None)
 
 
 class BaseConnector:
-    """Connects to the DB when instanciated"""
+    """Gives access to the DB through the process-wide client"""
 
     def __init__(self):
-        self.client = MongoClient(DB_ADDRESS)  # connecting to the db
+        self.client = get_client()
         self.db = self.client["wikiloult"]
 
 
+# users' state, as (lookup time, state), kept for USER_STATE_CACHE_TTL seconds
+_user_states_cache = {}
+_user_states_lock = threading.Lock()
+
+
+def invalidate_user_state(user_cookie: str):
+    _user_states_cache.pop(user_cookie, None)
+
+
 class UsersConnector(BaseConnector):
     """Connector dedicated to users"""
 
@@ -27,9 +206,29 @@ class UsersConnector(BaseConnector):
         super().__init__()
         self.users = self.db[USERS_COLLECTION_NAME]
 
+    def get_user_state(self, user_cookie: str) -> dict:
+        """Whether the user is registered, allowed to edit pages and an admin, in a single
+        query that doesn't load the rest of their document"""
+        if user_cookie is None:
+            return {"exists": False, "is_allowed": False, "is_admin": False}
+        if USER_STATE_CACHE_TTL:
+            cached = _user_states_cache.get(user_cookie)
+            if cached is not None and time.monotonic() - cached[0] < USER_STATE_CACHE_TTL:
+                return cached[1]
+
+        result = self.users.find_one({"_id": user_cookie}, {"is_allowed": 1})
+        state = {"exists": result is not None,
+                 "is_allowed": result is not None and result.get("is_allowed", False),
+                 "is_admin": user_cookie in ADMIN_COOKIES}
+        if USER_STATE_CACHE_TTL:
+            with _user_states_lock:
+                if len(_user_states_cache) >= USER_CACHE_SIZE:
+                    _user_states_cache.clear()
+                _user_states_cache[user_cookie] = (time.monotonic(), state)
+        return state
+
     def user_exists(self, user_cookie : str) -> bool:
-        result = self.users.find_one({"_id": user_cookie})
-        return result is not None
+        return self.get_user_state(user_cookie)["exists"]
 
     def register_user(self, user_cookie: str):
         """Registers user cookie as a new user. Sets authorization to pending."""
@@ -37,22 +236,46 @@ class UsersConnector(BaseConnector):
         new_user_data = {"_id": user_cookie,
                          "is_allowed": False,
                          "short_id": user_obj.user_id,
+                         "poke_name": user_obj.poke_name,
                          "modifications": [],
                          "registration_date": datetime.datetime.utcnow(),
                          "personal_text_markdown": None,
                          "personal_text_html": None}
         self.users.insert_one(new_user_data)
+        invalidate_user_state(user_cookie)
 
     def add_modification(self, user_cookie : str, page_name : str):
+        """Logs an edit, only the USER_MODIFICATIONS_LOG_SIZE last ones are kept"""
         self.users.update_one({"_id": user_cookie},
-                              {"$push": {"modifications": {"page": page_name,
-                                                           "date": datetime.datetime.utcnow()}}})
+                              {"$push": {"modifications": {"$each": [{"page": page_name,
+                                                                      "date": datetime.datetime.utcnow()}],
+                                                           "$slice": -USER_MODIFICATIONS_LOG_SIZE}}})
+
+    def get_user_data(self, user_id: str, modifications_count: int = USER_PAGE_MODIFICATIONS,
+                      modifications_after: str = None):
+        """Looks a user up by their short id, with a page of `modifications_count` of their edits,
+        newest first, starting after the `modifications_after` token. The token of the next page
+        is in "modifications_next", the previous one's in "modifications_previous".
 
-    def get_user_data(self, user_id: str):
-        return self.users.find_one({"short_id": user_id})
+        The edits are a capped array in the user's document rather than an indexed collection,
+        so the token holds a position in it: the array's tail is read up to the end of the page,
+        which costs at most USER_MODIFICATIONS_LOG_SIZE entries."""
+        offset = decode_offset(modifications_after, USER_MODIFICATIONS_LOG_SIZE)
+        projection = {"modifications": {"$slice": -(offset + modifications_count + 1)}} if modifications_count \
+            else {"modifications": 0}
+        user_data = self.users.find_one({"short_id": user_id}, projection)
+        if user_data is None:
+            return None
+        newest_first = user_data.get("modifications", [])[::-1]
+        user_data["modifications"] = newest_first[offset:offset + modifications_count]
+        user_data["modifications_next"] = encode_token(offset + modifications_count) \
+            if len(newest_first) > offset + modifications_count else None
+        user_data["modifications_previous"] = encode_token(max(offset - modifications_count, 0)) \
+            if offset > 0 else None
+        return user_data
 
     def update_user_text(self, user_cookie: str, markdown_content : str):
-        markdown_renderer = WikiPageRenderer()
+        markdown_renderer = get_renderer()
         html_render = markdown_renderer.render(escape(markdown_content))
         self.users.update_one({"_id": user_cookie},
                               {"$set": {"personal_text_html": html_render,
@@ -60,107 +283,314 @@ class UsersConnector(BaseConnector):
 
     def is_allowed(self, user_cookie: str) -> bool:
         """Looks up if a user is allowed to edit/create pages or not"""
-        result = self.users.find_one({"_id": user_cookie})
-        return False if result is None else result["is_allowed"]
+        return self.get_user_state(user_cookie)["is_allowed"]
+
+
+def make_revision(page_name: str, rev: int, markdown_content: str, previous_markdown, page_title: str,
+                  editor_cookie: str, edition_time: datetime.datetime):
+    """Builds a revision document: a full snapshot every REVISION_SNAPSHOT_INTERVAL revisions
+    (and for the first one), else a delta against the previous revision's markdown"""
+    revision = {"page": page_name,
+                "rev": rev,
+                "editor_cookie": editor_cookie,
+                "edition_time": edition_time,
+                "title": page_title}
+    if previous_markdown is None or rev % REVISION_SNAPSHOT_INTERVAL == 0:
+        revision["markdown"] = markdown_content
+    else:
+        revision["delta"] = make_delta(previous_markdown, markdown_content)
+    return revision
+
+
+def page_text_fields(html_content: str) -> dict:
+    """Plain text version of a page, for the search index and results"""
+    return {"raw_text": html_to_text(html_content)}
+
+
+def page_editor_fields(editor_cookie: str) -> dict:
+    """The last editor of a page, stored along with it for the admin's pages list"""
+    return {"last_editor_cookie": editor_cookie,
+            "last_editor": User(editor_cookie).poke_name}
+
+
+def page_index_fields(page_title: str) -> dict:
+    """Fields of a page document that are derived from its title, used by the pages index"""
+    return {"sort_key": title_sort_key(page_title),
+            "first_letter": title_first_letter(page_title)}
+
+
+# set once the capped collection of the recent edits feed is known to exist
+_recent_edits_checked = False
+
+# names of all the pages, to pick random ones from
+_random_pages_cache = {"names": [], "loaded_at": None}
+_random_pages_lock = threading.Lock()
+
+
+def invalidate_random_pages():
+    _random_pages_cache["loaded_at"] = None
+
+
+def group_by_first_letter(pages):
+    """(letter, pages) pairs of alphabetically sorted pages"""
+    return groupby(pages, key=lambda page_data: page_data.get("first_letter")
+                                                or title_first_letter(page_data["title"]))
+
+
+def make_recent_edit(page_name: str, page_title: str, html_content: str, editor_cookie: str,
+                     edition_time: datetime.datetime):
+    return {"page": page_name,
+            "title": page_title,
+            "snippet": make_snippet(html_to_text(html_content)),
+            "editor_cookie": editor_cookie,
+            "edition_time": edition_time}
+
+
+class SearchResults:
+    """A page of search results, looked up on first use, and the tokens of the pages around it.
+
+    The results are ranked by relevance, which can't be filtered on in a query, so unlike the
+    other listings the tokens hold a page number. Both backends score all the matching pages
+    before ranking them anyway, skipping some of them adds little."""
+
+    def __init__(self, page_cnctr, search_query: str, token: str, per_page: int):
+        self.page = decode_offset(token, SEARCH_MAX_PAGES - 1)
+        self._search = lambda: page_cnctr.search_pages(search_query, self.page, per_page)
+        self._results = None
+
+    def _run(self):
+        if self._results is None:
+            self._results, self._has_next = self._search()
+
+    def __iter__(self):
+        self._run()
+        return iter(self._results)
+
+    @property
+    def previous_token(self):
+        return encode_token(self.page - 1) if self.page > 0 else None
+
+    @property
+    def next_token(self):
+        self._run()
+        return encode_token(self.page + 1) if self._has_next and self.page + 1 < SEARCH_MAX_PAGES else None
 
 
 class WikiPagesConnector(BaseConnector):
 
+    # fields of the revisions that are enough to list them
+    REVISION_SUMMARY = {"_id": 0, "rev": 1, "editor_cookie": 1, "edition_time": 1, "title": 1}
+
     def __init__(self):
         super().__init__()
         self.pages = self.db[PAGES_COLLECTION_NAME]
+        self.revisions = self.db[REVISIONS_COLLECTION_NAME]
+        self.recent_edits = self.db[RECENT_EDITS_COLLECTION_NAME]
+        self.meta = self.db[META_COLLECTION_NAME]
+
+    def bump_version(self):
+        """Increments the counter of changes to the wiki's pages, which invalidates the
+        caches built from the whole collection"""
+        self.meta.update_one({"_id": "pages_version"}, {"$inc": {"value": 1}}, upsert=True)
+
+    def get_version(self) -> int:
+        result = self.meta.find_one({"_id": "pages_version"})
+        return 0 if result is None else result["value"]
+
+    def create_recent_edits_collection(self):
+        """(Re)creates the capped collection holding the recent edits feed"""
+        if RECENT_EDITS_COLLECTION_NAME in self.db.list_collection_names():
+            self.recent_edits.drop()
+        self.db.create_collection(RECENT_EDITS_COLLECTION_NAME, capped=True,
+                                  size=RECENT_EDITS_MAX_SIZE, max=RECENT_EDITS_MAX_COUNT)
+
+    def ensure_recent_edits_collection(self):
+        """Creates the recent edits feed's capped collection if it's missing, so that the first
+        edit doesn't create an ordinary one that grows without bound. Checked once per process."""
+        global _recent_edits_checked
+        if _recent_edits_checked:
+            return
+        try:
+            self.db.create_collection(RECENT_EDITS_COLLECTION_NAME, capped=True,
+                                      size=RECENT_EDITS_MAX_SIZE, max=RECENT_EDITS_MAX_COUNT)
+        except CollectionInvalid:
+            # it already exists
+            if not self.recent_edits.options().get("capped"):
+                logger.error("The %s collection isn't capped, run manage.py backfill-recent-edits to recreate it",
+                             RECENT_EDITS_COLLECTION_NAME)
+        _recent_edits_checked = True
 
     def create_page(self, page_name : str, markdown_content: str, page_title: str, editor_cookie: str):
-        markdown_renderer = WikiPageRenderer()
+        markdown_renderer = get_renderer()
         page_render = markdown_renderer.render(escape(markdown_content))
+        now = datetime.datetime.utcnow()
         page_data = {"_id": page_name,
                      "title": page_title,
                      "html_content": page_render,
                      "markdown_content": markdown_content,
-                     "history": [{"editor_cookie": editor_cookie,
-                                  "markdown": markdown_content,
-                                  "edition_time": datetime.datetime.utcnow()}],
-                     "last_edit": datetime.datetime.utcnow(),
-                     "creation_date": datetime.datetime.utcnow()}
+                     "revision_count": 1,
+                     "last_edit": now,
+                     "creation_date": now}
+        page_data.update(page_editor_fields(editor_cookie))
+        page_data.update(page_index_fields(page_title))
+        page_data.update(page_text_fields(page_render))
         self.pages.insert_one(page_data)
+        invalidate_random_pages()
+        get_search_backend().update_page(page_name, page_title, page_data["raw_text"])
+        self.bump_version()
+        self.revisions.insert_one(make_revision(page_name, 0, markdown_content, None,
+                                                page_title, editor_cookie, now))
+        self.ensure_recent_edits_collection()
+        self.recent_edits.insert_one(make_recent_edit(page_name, page_title, page_render, editor_cookie, now))
+        # once the revision is there, as the page's body lists its last editors
+        get_fragment_cache().invalidate(page_name)
 
     def edit_page(self, page_name: str, markdown_content: str, page_title: str, editor_cookie: str):
-        markdown_renderer = WikiPageRenderer()
+        markdown_renderer = get_renderer()
         new_render = markdown_renderer.render(escape(markdown_content))
-        history_entry = {"editor_cookie": editor_cookie,
-                         "markdown": markdown_content,
-                         "edition_time": datetime.datetime.utcnow(),
-                         "title" : page_title}
-        self.pages.update_one({"_id": page_name},
-                              {"$push": {"history": history_entry},
-                               "$set": {"html_content": new_render,
-                                        "markdown_content" : markdown_content,
-                                        "title": page_title,
-                                        "last_edit": datetime.datetime.utcnow()}})
+        text_fields = page_text_fields(new_render)
+        now = datetime.datetime.utcnow()
+        # the revision number is reserved atomically, and the document as it was before the
+        # update holds the markdown the delta is computed against
+        previous = self.pages.find_one_and_update({"_id": page_name},
+                                                  {"$inc": {"revision_count": 1},
+                                                   "$set": {"html_content": new_render,
+                                                            "markdown_content": markdown_content,
+                                                            "title": page_title,
+                                                            "last_edit": now,
+                                                            **page_editor_fields(editor_cookie),
+                                                            **page_index_fields(page_title),
+                                                            **text_fields}},
+                                                  projection={"markdown_content": 1, "revision_count": 1},
+                                                  return_document=ReturnDocument.BEFORE)
+        if previous is None:
+            return
+        self.bump_version()
+        get_search_backend().update_page(page_name, page_title, text_fields["raw_text"])
+        self.revisions.insert_one(make_revision(page_name, previous.get("revision_count", 0), markdown_content,
+                                                previous["markdown_content"], page_title, editor_cookie, now))
+        self.ensure_recent_edits_collection()
+        self.recent_edits.insert_one(make_recent_edit(page_name, page_title, new_render, editor_cookie, now))
+        get_fragment_cache().invalidate(page_name)
 
     def page_exists(self, page_name: str) -> bool:
-        result = self.pages.find_one({"_id": page_name})
+        result = self.pages.find_one({"_id": page_name}, {"_id": 1})
         return result is not None
 
-    def search_pages(self, search_query: str):
-        return list(self.pages.find({"$text": {"$search": search_query.lower()}}))
+    def search(self, search_query: str, token: str = None, per_page: int = SEARCH_PAGE_SIZE):
+        """Same as `search_pages`, but paginated with tokens, and the search only runs once the
+        results are iterated"""
+        return SearchResults(self, search_query, token, per_page)
+
+    def search_pages(self, search_query: str, page: int = 0, per_page: int = SEARCH_PAGE_SIZE):
+        """Returns a page of results, best matches first, and whether there are more. Each result
+        has a snippet of its text around the searched terms, with the terms highlighted."""
+        if page < 0:
+            return [], False
+        results, has_next = get_search_backend().search(self.pages, search_query, page, per_page)
+        terms = search_terms(search_query)
+        for result in results:
+            result["snippet"] = highlight_snippet(result.pop("raw_text", ""), terms)
+        return results, has_next
+
+    def get_page_summary(self, page_name: str):
+        """The few fields telling if a page changed, without its content"""
+        return self.pages.find_one({"_id": page_name}, {"title": 1, "last_edit": 1, "revision_count": 1})
 
     def get_page_data(self, page_name: str):
-        page_data = self.pages.find_one({"_id": page_name})
+        page_data = self.pages.find_one({"_id": page_name}, {"history": 0})
         if page_data is None:
             return None
         condensed_history = []
         prev_editor = None
-        for entry in page_data["history"]:
+        last_revisions = self.revisions.find({"page": page_name}, self.REVISION_SUMMARY) \
+            .sort("rev", DESCENDING).limit(CONDENSED_HISTORY_SIZE)
+        for entry in last_revisions:
             if prev_editor != entry["editor_cookie"]:
                 condensed_history.append({"editor": User(entry["editor_cookie"]),
                                           "edition_time": entry["edition_time"]})
                 prev_editor = entry["editor_cookie"]
-        page_data["history"] = condensed_history[::-1]
+        page_data["history"] = condensed_history
         return page_data
 
-    def get_page_history(self, page_name : str):
-        page_data = self.pages.find_one({"_id": page_name})
-        if page_data is None:
+    def get_page_history(self, page_name : str, after: str = None, before: str = None,
+                         per_page: int = HISTORY_PAGE_SIZE) -> ResultsPage:
+        """Returns a page of the page's revisions, newest first, paginated on the (page, rev)
+        index. The revisions' content isn't loaded (see `get_revision`)."""
+        history = keyset_page(self.revisions, {"page": page_name}, [("rev", DESCENDING)], per_page,
+                              self.REVISION_SUMMARY, after, before)
+        for entry in history.items:
+            entry["edit_id"] = entry["rev"]
+            entry["editor"] = User(entry["editor_cookie"])
+        return history
+
+    def get_revision_markdown(self, page_name: str, rev: int):
+        """Rebuilds a revision's markdown from the closest snapshot preceding it, which is at
+        most REVISION_SNAPSHOT_INTERVAL revisions away. Returns the revision without its delta."""
+        chain = []
+        cursor = self.revisions.find({"page": page_name, "rev": {"$lte": rev}}, {"_id": 0}) \
+            .sort("rev", DESCENDING).batch_size(REVISION_SNAPSHOT_INTERVAL + 1)
+        for revision in cursor:
+            chain.append(revision)
+            if "markdown" in revision:
+                break
+        cursor.close()
+        if not chain or chain[0]["rev"] != rev or "markdown" not in chain[-1]:
             return None
 
-        markdown_renderer = WikiPageRenderer()
-        edit_title = page_data["title"]
-        for i, entry in enumerate(page_data["history"]):
-            if "title" in entry:
-                edit_title = entry["title"]
-            entry["title"] = edit_title
-            entry["render"] = markdown_renderer.render(escape(entry["markdown"]))
-            entry["edit_id"] = i
-            entry["editor"] = User(entry["editor_cookie"])
-        return page_data["history"]
+        markdown_content = chain[-1]["markdown"]
+        for revision in reversed(chain[:-1]):
+            markdown_content = apply_delta(markdown_content, revision["delta"])
+        revision = chain[0]
+        revision.pop("delta", None)
+        revision["markdown"] = markdown_content
+        return revision
+
+    def get_revision(self, page_name: str, edit_id: int):
+        """Fetches a single revision by its number, rendered"""
+        if edit_id < 0:
+            return None
+        entry = self.get_revision_markdown(page_name, edit_id)
+        if entry is None:
+            return None
+        entry["edit_id"] = edit_id
+        entry["editor"] = User(entry["editor_cookie"])
+        entry["render"] = get_renderer().render(escape(entry["markdown"]))
+        return entry
+
+    def get_last_editor(self, page_name: str):
+        revision = self.revisions.find_one({"page": page_name}, {"editor_cookie": 1},
+                                           sort=[("rev", DESCENDING)])
+        return None if revision is None else revision["editor_cookie"]
+
+    def delete_revisions(self, page_name: str):
+        self.revisions.delete_many({"page": page_name})
 
     def get_random_page(self):
-        result = self.pages.aggregate([{"$sample": {"size": 1}}])
-        return next(result)["_id"]
+        """Picks a random page name, or None if the wiki is empty. The names are kept in memory,
+        and reloaded after RANDOM_PAGES_REFRESH_INTERVAL seconds, or once this process created
+        or deleted a page."""
+        loaded_at = _random_pages_cache["loaded_at"]
+        if loaded_at is None or time.monotonic() - loaded_at > RANDOM_PAGES_REFRESH_INTERVAL:
+            names = [page_data["_id"] for page_data in self.pages.find({}, {"_id": 1})]
+            with _random_pages_lock:
+                _random_pages_cache["names"], _random_pages_cache["loaded_at"] = names, time.monotonic()
+        names = _random_pages_cache["names"]
+        return random.choice(names) if names else None
 
     def get_last_edited(self, number: int):
-        return list(self.pages.aggregate([{"$unwind": "$history"},
-                                          {"$sort": {"history.edition_time": -1}},
-                                          {"$limit": number}]))
-
-    def get_all_pages_sorted(self):
-
-        def remove_accents(text):
-            return ''.join(c for c in unicodedata.normalize('NFD', text)
-                    if unicodedata.category(c) != 'Mn')
-
-        def get_first_letter(text: str):
-            text = text.lower()
-            if text.startswith(("le", "la", "l'", "les")):
-                text = re.sub(r"^(le|l'|la|les)\s+", "", text)
-            return text[0]
-
-        query = self.pages.find().sort("title", 1)
-        per_first_letter = OrderedDict()
-        for page_data in query:
-            first_letter = get_first_letter(remove_accents(page_data["title"]))
-            if first_letter not in per_first_letter:
-                per_first_letter[first_letter] = []
-            per_first_letter[first_letter].append(page_data)
-        return per_first_letter
\ No newline at end of file
+        """Returns the `number` last edits, newest first, from the recent edits feed"""
+        return list(self.recent_edits.find({}, {"_id": 0}).sort("$natural", DESCENDING).limit(number))
+
+    def get_pages_sorted(self, after: str = None, before: str = None,
+                         per_page: int = ALL_PAGES_PAGE_SIZE) -> ResultsPage:
+        """A page of the pages index, in alphabetical order, with only the pages' titles"""
+        return keyset_page(self.pages, {}, [("sort_key", ASCENDING), ("_id", ASCENDING)], per_page,
+                           {"title": 1, "first_letter": 1, "sort_key": 1}, after, before)
+
+    def iter_pages_sorted(self):
+        """Pages grouped by first letter, in alphabetical order, as (letter, pages) pairs. Both
+        are lazy: the pages are read from the cursor on the sort_key index as they're used,
+        with only their titles. Used to list all the pages at once."""
+        query = self.pages.find({}, {"title": 1, "first_letter": 1}).sort("sort_key", ASCENDING)
+        return group_by_first_letter(query)
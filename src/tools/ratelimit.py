@@ -0,0 +1,170 @@
+"""Storages for flask-limiter's counters that are shared by all the workers, so that a limit
+like "1/day" holds for the whole site rather than for each process. Importing this module
+registers them with the `limits` package, under the schemes:
+
+- ``wikiloult+mongodb://``: the wiki's own MongoDB (through the shared client), for any number
+  of hosts. The counters are incremented with $inc.
+- ``wikiloult+sqlite:///path/to/file.sqlite``: a SQLite file, for workers on a single host. The
+  counters are incremented by an upsert in a write transaction.
+
+Both count in fixed windows, which the first hit after a counter expired restarts."""
+import datetime
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+from limits.storage import Storage
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from config import RATE_LIMITS_COLLECTION_NAME
+from .models import get_client
+
+
+def _utc_datetime(timestamp: float) -> datetime.datetime:
+    # naive UTC, like the other dates in the database
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+
+def _timestamp(date: datetime.datetime) -> float:
+    return date.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class MongoLimitsStorage(Storage):
+
+    STORAGE_SCHEME = ["wikiloult+mongodb"]
+
+    def __init__(self, uri: str = None, collection=None, **options):
+        super().__init__(uri, **options)
+        # a stand-in for the collection, mongomock's for instance
+        self._collection = collection
+
+    @property
+    def collection(self):
+        # looked up on each use: the storage is built when the app is imported, possibly before
+        # the workers are forked, and each process has its own client
+        if self._collection is not None:
+            return self._collection
+        return get_client()["wikiloult"][RATE_LIMITS_COLLECTION_NAME]
+
+    @property
+    def base_exceptions(self):
+        return PyMongoError
+
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1) -> int:
+        now = time.time()
+        expire_at = _utc_datetime(now + expiry)
+        # an expired window is restarted, then the counter is incremented: both updates are
+        # atomic, and once the first one is done it can't match again until the new window ends
+        self.collection.update_one({"_id": key, "expire_at": {"$lte": _utc_datetime(now)}},
+                                   {"$set": {"count": 0, "expire_at": expire_at}})
+        update = {"$inc": {"count": amount}}
+        if elastic_expiry:
+            update["$set"] = {"expire_at": expire_at}
+        else:
+            update["$setOnInsert"] = {"expire_at": expire_at}
+        try:
+            counter = self.collection.find_one_and_update({"_id": key}, update, upsert=True,
+                                                          return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # another process inserted the counter at the same time, it exists now
+            counter = self.collection.find_one_and_update({"_id": key}, update,
+                                                          return_document=ReturnDocument.AFTER)
+        return counter["count"]
+
+    def _live_counter(self, key: str):
+        return self.collection.find_one({"_id": key, "expire_at": {"$gt": _utc_datetime(time.time())}})
+
+    def get(self, key: str) -> int:
+        counter = self._live_counter(key)
+        return 0 if counter is None else counter["count"]
+
+    def get_expiry(self, key: str) -> float:
+        counter = self._live_counter(key)
+        return time.time() if counter is None else _timestamp(counter["expire_at"])
+
+    def check(self) -> bool:
+        try:
+            self.collection.find_one({}, {"_id": 1})
+            return True
+        except PyMongoError:
+            return False
+
+    def reset(self):
+        return self.collection.delete_many({}).deleted_count
+
+    def clear(self, key: str):
+        self.collection.delete_one({"_id": key})
+
+
+class SQLiteLimitsStorage(Storage):
+
+    STORAGE_SCHEME = ["wikiloult+sqlite"]
+
+    def __init__(self, uri: str, **options):
+        super().__init__(uri, **options)
+        self.path = urlparse(uri).path
+        # sqlite connections can't be shared by threads
+        self._connections = threading.local()
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS rate_limits "
+                           "(key TEXT PRIMARY KEY, count INTEGER NOT NULL, expire_at REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS rate_limits_expire_at ON rate_limits (expire_at)")
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._connections, "connection", None)
+        if connection is None:
+            # isolation_level=None: transactions are opened explicitly, see `incr`
+            connection = self._connections.connection = sqlite3.connect(self.path, timeout=10,
+                                                                        isolation_level=None)
+        return connection
+
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1) -> int:
+        now = time.time()
+        connection = self._connection()
+        # BEGIN IMMEDIATE takes the write lock at once, so the read of the new value can't
+        # interleave with another process' update
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # the expired counters are dropped, this one included, which restarts its window
+            connection.execute("DELETE FROM rate_limits WHERE expire_at <= ?", (now,))
+            connection.execute("INSERT INTO rate_limits (key, count, expire_at) VALUES (?, ?, ?) "
+                               "ON CONFLICT (key) DO UPDATE SET count = count + excluded.count, "
+                               "expire_at = CASE WHEN ? THEN excluded.expire_at ELSE expire_at END",
+                               (key, amount, now + expiry, elastic_expiry))
+            count = connection.execute("SELECT count FROM rate_limits WHERE key = ?", (key,)).fetchone()[0]
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return count
+
+    def _live_counter(self, key: str):
+        return self._connection().execute("SELECT count, expire_at FROM rate_limits WHERE key = ? AND expire_at > ?",
+                                          (key, time.time())).fetchone()
+
+    def get(self, key: str) -> int:
+        counter = self._live_counter(key)
+        return 0 if counter is None else counter[0]
+
+    def get_expiry(self, key: str) -> float:
+        counter = self._live_counter(key)
+        return time.time() if counter is None else counter[1]
+
+    def check(self) -> bool:
+        try:
+            self._connection().execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        return self._connection().execute("DELETE FROM rate_limits").rowcount
+
+    def clear(self, key: str):
+        self._connection().execute("DELETE FROM rate_limits WHERE key = ?", (key,))
@@ -1,7 +1,16 @@
+from collections import OrderedDict
+from hashlib import sha1
+from os.path import splitext
 import re
+import subprocess
+import threading
+
 from mistune import Renderer, InlineLexer, Markdown
 import voxpopuli
 
+from config import RENDER_CACHE_SIZE
+from .metrics import timed
+
 
 class WikiloultRenderer(Renderer):
 
@@ -21,6 +30,11 @@ class WikiloultRenderer(Renderer):
 
 class WikiloultLexer(InlineLexer):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # own copy of the rules list, else the enable_* methods below would grow the class-wide list
+        self.default_rules = list(self.default_rules)
+
     def enable_wiki_link(self):
         # add wiki_link rules
         self.rules.wiki_link = re.compile(
@@ -51,21 +65,114 @@ class WikiloultLexer(InlineLexer):
         return self.renderer.vocaroo_link(vocaroo_id)
 
 
+def build_markdown_engine() -> Markdown:
+    wiki_link_renderer = WikiloultRenderer()
+    link_lexer = WikiloultLexer(wiki_link_renderer)
+    link_lexer.enable_wiki_link()
+    link_lexer.enable_vocaroo_link()
+    return Markdown(wiki_link_renderer, inline=link_lexer)
+
+
+class RenderCache:
+    """Bounded LRU cache of rendered HTML, keyed by a hash of the markdown input"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(page_string: str):
+        return sha1(page_string.encode("utf8")).digest()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return html
+
+    def put(self, key, html: str):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class WikiPageRenderer:
+    """Renders the wiki's markdown. Instances are cheap: all of them share the same cache,
+    and the mistune engine (which keeps parsing state, hence isn't thread-safe) is built
+    once per thread."""
 
-    def __init__(self):
-        wiki_link_renderer = WikiloultRenderer()
-        link_lexer = WikiloultLexer(wiki_link_renderer)
-        link_lexer.enable_wiki_link()
-        link_lexer.enable_vocaroo_link()
-        self.renderer = Markdown(wiki_link_renderer, inline=link_lexer)
+    cache = RenderCache(RENDER_CACHE_SIZE)
+    _engines = threading.local()
 
+    @property
+    def renderer(self) -> Markdown:
+        engine = getattr(self._engines, "markdown", None)
+        if engine is None:
+            engine = self._engines.markdown = build_markdown_engine()
+        return engine
+
+    @timed("render")
     def render(self, page_string : str):
-        return self.renderer(page_string)
+        key = self.cache.key(page_string)
+        html = self.cache.get(key)
+        if html is None:
+            html = self.renderer(page_string)
+            self.cache.put(key, html)
+        return html
 
 
-def audio_render(text, render_path):
-    voice = voxpopuli.Voice(lang="fr", voice_id=1, pitch=60, speed=110)
+_renderer = WikiPageRenderer()
+
+
+def get_renderer() -> WikiPageRenderer:
+    return _renderer
+
+
+AUDIO_VOICE = {"lang": "fr", "voice_id": 1, "pitch": 60, "speed": 110}
+
+# ffmpeg arguments for the compressed output formats, picked from the file's extension
+AUDIO_CODECS = {"ogg": ["-c:a", "libopus", "-b:a", "32k"],
+                "mp3": ["-c:a", "libmp3lame", "-q:a", "6"]}
+
+
+def normalize_audio_text(text):
     text = text.replace('#', 'hashtag ')
-    text = text.strip(' -"\'`$();:.')
-    voice.to_audio(text, filename=render_path)
\ No newline at end of file
+    text = " ".join(text.split())
+    return text.strip(' -"\'`$();:.')
+
+
+@timed("audio_render")
+def audio_render(text, render_path):
+    voice = voxpopuli.Voice(**AUDIO_VOICE)
+    text = normalize_audio_text(text)
+    extension = splitext(render_path)[1].lstrip(".")
+    if extension not in AUDIO_CODECS:
+        voice.to_audio(text, filename=render_path)
+        return
+    wav_data = voice.to_audio(text)
+    subprocess.run(["ffmpeg", "-loglevel", "error", "-y", "-f", "wav", "-i", "pipe:0",
+                    *AUDIO_CODECS[extension], render_path],
+                   input=wav_data, check=True)
\ No newline at end of file
@@ -0,0 +1,424 @@
+"""Search backends. The "mongo" one relies on MongoDB's text index; the "inverted_index" one
+is an in-process BM25 index over the pages' plain text, which folds accents and case and
+matches the last word of the query as a prefix (for search-as-you-type).
+
+The inverted index lives in a folder shared by all the workers of a host:
+
+- a snapshot file, memory-mapped by every worker, so they start warm and share its pages
+- a journal, where page updates are appended as they happen and that every worker replays
+  before searching. It's merged into a new snapshot, by a background thread, when it grows
+  too big.
+"""
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+import fcntl
+import json
+import math
+import mmap
+import os
+from os.path import join, dirname, realpath, exists
+import re
+import struct
+import threading
+
+from config import SEARCH_BACKEND, SEARCH_JOURNAL_MAX_SIZE
+from .text import remove_accents, search_terms
+
+INDEX_FOLDER = join(dirname(dirname(realpath(__file__))), "search_index")
+
+WORD_REGEX = re.compile(r"\w+")
+# a word of the title counts as much as this many occurrences in the text
+TITLE_WEIGHT = 3
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# maximum number of words a prefix is expanded to
+MAX_PREFIX_EXPANSIONS = 64
+
+RESULT_FIELDS = {"title": 1, "raw_text": 1, "last_edit": 1}
+
+
+def tokenize(text: str) -> list:
+    return WORD_REGEX.findall(remove_accents(text).lower())
+
+
+def page_terms(title: str, raw_text: str):
+    """Returns a page's length (in words) and its words' frequencies"""
+    terms = Counter(tokenize(raw_text))
+    for term in tokenize(title):
+        terms[term] += TITLE_WEIGHT
+    return sum(terms.values()), dict(terms)
+
+
+def read_journal(journal_path: str, offset: int):
+    """The journal's entries past the offset, and the number of bytes they take. A line that's
+    still being written is left for later"""
+    with open(journal_path, "rb") as journal:
+        journal.seek(offset)
+        data = journal.read()
+    complete = data[:data.rfind(b"\n") + 1]
+    return [json.loads(line) for line in complete.splitlines()], len(complete)
+
+
+def apply_entries(documents: dict, entries: list):
+    for entry in entries:
+        if entry["op"] == "put":
+            documents[entry["page"]] = (entry["length"], entry["terms"])
+        else:
+            documents.pop(entry["page"], None)
+
+
+class MongoTextSearch:
+    """Search through MongoDB's text index, which MongoDB keeps up to date by itself"""
+
+    def search(self, pages, search_query: str, page: int, per_page: int):
+        # one extra result tells if there's a next page
+        results = list(pages.find({"$text": {"$search": search_query.lower()}},
+                                  {"score": {"$meta": "textScore"}, **RESULT_FIELDS})
+                       .sort([("score", {"$meta": "textScore"})])
+                       .skip(page * per_page).limit(per_page + 1))
+        return results[:per_page], len(results) > per_page
+
+    def update_page(self, page_name: str, title: str, raw_text: str):
+        pass
+
+    def remove_page(self, page_name: str):
+        pass
+
+
+class IndexSnapshot:
+    """Read-only, memory-mapped inverted index. Layout, after the header (integers are
+    native-endian uint32, sections are 4-bytes aligned):
+
+    - the documents' lengths, then the end offsets of their names in the names blob
+    - the names blob (utf8)
+    - the end offsets of the terms in the terms blob (terms are sorted by their utf8 bytes),
+      then for each term the index of its first posting, plus a last one for the total
+    - the terms blob (utf8)
+    - the postings: (document index, term frequency) pairs, grouped by term
+    """
+
+    MAGIC = b"WLSI"
+    VERSION = 1
+    HEADER = struct.Struct("<4sIIIIII")  # magic, version, docs, terms, names size, terms size, postings
+
+    def __init__(self, path: str):
+        with open(path, "rb") as index_file:
+            self._mmap = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.n_docs, self.n_terms, names_size, terms_size, n_postings = \
+            self.HEADER.unpack_from(self._mmap, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("%s isn't a search index snapshot" % path)
+
+        view = memoryview(self._mmap)
+        offset = self.HEADER.size
+
+        def section(size: int, uint32: bool):
+            nonlocal offset
+            data = view[offset:offset + size]
+            offset += size + (-size % 4)
+            return data.cast("I") if uint32 else data
+
+        self.doc_lengths = section(4 * self.n_docs, True)
+        self._name_ends = section(4 * self.n_docs, True)
+        self._names = section(names_size, False)
+        self._term_ends = section(4 * self.n_terms, True)
+        self._postings_starts = section(4 * (self.n_terms + 1), True)
+        self._terms = section(terms_size, False)
+        self._postings = section(8 * n_postings, True)
+
+        self.total_length = sum(self.doc_lengths)
+        self.doc_ids = {self.doc_name(doc): doc for doc in range(self.n_docs)}
+
+    def doc_name(self, doc: int) -> str:
+        start = self._name_ends[doc - 1] if doc else 0
+        return bytes(self._names[start:self._name_ends[doc]]).decode("utf8")
+
+    def term(self, term_index: int) -> bytes:
+        start = self._term_ends[term_index - 1] if term_index else 0
+        return bytes(self._terms[start:self._term_ends[term_index]])
+
+    def _lower_bound(self, term: bytes) -> int:
+        low, high = 0, self.n_terms
+        while low < high:
+            middle = (low + high) // 2
+            if self.term(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find_term(self, term: str):
+        encoded = term.encode("utf8")
+        index = self._lower_bound(encoded)
+        return index if index < self.n_terms and self.term(index) == encoded else None
+
+    def prefixed_terms(self, prefix: str, limit: int):
+        """Indexes and values of the terms starting with the prefix"""
+        encoded = prefix.encode("utf8")
+        index = self._lower_bound(encoded)
+        while index < self.n_terms and limit > 0:
+            term = self.term(index)
+            if not term.startswith(encoded):
+                break
+            yield index, term.decode("utf8")
+            index += 1
+            limit -= 1
+
+    def postings(self, term_index: int):
+        start, end = self._postings_starts[term_index], self._postings_starts[term_index + 1]
+        pairs = self._postings[2 * start:2 * end]
+        return zip(pairs[::2], pairs[1::2])
+
+    def documents(self):
+        """Rebuilds every document's (length, terms), to write a new snapshot"""
+        documents = {self.doc_name(doc): (self.doc_lengths[doc], {}) for doc in range(self.n_docs)}
+        names = list(documents)
+        for term_index in range(self.n_terms):
+            term = self.term(term_index).decode("utf8")
+            for doc, frequency in self.postings(term_index):
+                documents[names[doc]][1][term] = frequency
+        return documents
+
+    @classmethod
+    def write(cls, path: str, documents: dict):
+        """Writes a snapshot of the documents, a dict of page name -> (length, terms)"""
+        names = sorted(documents)
+        postings = {}
+        for doc, name in enumerate(names):
+            for term, frequency in documents[name][1].items():
+                postings.setdefault(term.encode("utf8"), []).append((doc, frequency))
+        terms = sorted(postings)
+
+        names_blob = b"".join(name.encode("utf8") for name in names)
+        terms_blob = b"".join(terms)
+        name_ends, term_ends, postings_starts, postings_data = array("I"), array("I"), array("I", [0]), array("I")
+        for name in names:
+            name_ends.append((name_ends[-1] if name_ends else 0) + len(name.encode("utf8")))
+        for term in terms:
+            term_ends.append((term_ends[-1] if term_ends else 0) + len(term))
+            for doc, frequency in postings[term]:
+                postings_data.extend((doc, frequency))
+            postings_starts.append(postings_starts[-1] + len(postings[term]))
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as index_file:
+            index_file.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(names), len(terms),
+                                             len(names_blob), len(terms_blob), len(postings_data) // 2))
+            for data in (array("I", (documents[name][0] for name in names)), name_ends, names_blob,
+                         term_ends, postings_starts, terms_blob, postings_data):
+                data = data if isinstance(data, bytes) else data.tobytes()
+                index_file.write(data + b"\0" * (-len(data) % 4))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        # readers either see the old snapshot or the complete new one
+        os.replace(tmp_path, path)
+
+
+class InvertedIndexSearch:
+
+    def __init__(self, folder: str = INDEX_FOLDER, journal_max_size: int = SEARCH_JOURNAL_MAX_SIZE):
+        self.snapshot_path = join(folder, "pages.index")
+        self.journal_path = join(folder, "pages.journal")
+        self.lock_path = join(folder, "pages.lock")
+        self.journal_max_size = journal_max_size
+        os.makedirs(folder, exist_ok=True)
+        self._lock = threading.RLock()
+        self._snapshot = None
+        self._snapshot_inode = None
+        self._journal_offset = 0
+        # pages added or updated since the snapshot, and the snapshot's pages that are outdated
+        self._overlay = {}
+        self._removed = set()
+        self._compaction = None
+
+    @contextmanager
+    def _file_lock(self, shared: bool = False):
+        """Serializes the writes to the index files between processes. Readers take it shared,
+        so they never see a new snapshot with the journal of the old one"""
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Catches up with the files: reloads the snapshot if another process wrote a new one,
+        then replays the journal entries that haven't been seen yet"""
+        with self._file_lock(shared=True):
+            try:
+                inode = os.stat(self.snapshot_path).st_ino
+            except FileNotFoundError:
+                inode = None
+            try:
+                journal_size = os.stat(self.journal_path).st_size
+            except FileNotFoundError:
+                journal_size = 0
+
+            if inode != self._snapshot_inode or journal_size < self._journal_offset:
+                self._snapshot = IndexSnapshot(self.snapshot_path) if inode is not None else None
+                self._snapshot_inode = inode
+                self._journal_offset = 0
+                self._overlay, self._removed = {}, set()
+
+            if journal_size > self._journal_offset:
+                entries, read = read_journal(self.journal_path, self._journal_offset)
+                for entry in entries:
+                    self._apply(entry)
+                self._journal_offset += read
+
+    def _apply(self, entry: dict):
+        # entries can be applied several times, each one sets the page's final state
+        self._removed.add(entry["page"])
+        if entry["op"] == "put":
+            self._overlay[entry["page"]] = (entry["length"], entry["terms"])
+        else:
+            self._overlay.pop(entry["page"], None)
+
+    def _append(self, entry: dict):
+        with self._file_lock():
+            with open(self.journal_path, "ab") as journal:
+                journal.write(json.dumps(entry, ensure_ascii=False).encode("utf8") + b"\n")
+                journal_size = journal.tell()
+        if journal_size > self.journal_max_size:
+            self._compact_in_background()
+
+    def _compact_in_background(self):
+        # merging rebuilds every posting, the edit that filled the journal doesn't wait for it
+        with self._lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                return
+            self._compaction = threading.Thread(target=self.compact, name="search-index-compaction",
+                                                daemon=True)
+            self._compaction.start()
+
+    def update_page(self, page_name: str, title: str, raw_text: str):
+        length, terms = page_terms(title, raw_text)
+        self._append({"op": "put", "page": page_name, "length": length, "terms": terms})
+
+    def remove_page(self, page_name: str):
+        self._append({"op": "del", "page": page_name})
+
+    def compact(self):
+        """Merges the journal into a new snapshot. The documents are rebuilt without holding the
+        lock, only the entries journaled meanwhile are replayed (and the files replaced) under it"""
+        with self._file_lock(shared=True):
+            inode = os.stat(self.snapshot_path).st_ino if exists(self.snapshot_path) else None
+            snapshot = IndexSnapshot(self.snapshot_path) if inode is not None else None
+            entries, journal_offset = read_journal(self.journal_path, 0) if exists(self.journal_path) else ([], 0)
+        documents = snapshot.documents() if snapshot is not None else {}
+        apply_entries(documents, entries)
+
+        with self._file_lock():
+            current_inode = os.stat(self.snapshot_path).st_ino if exists(self.snapshot_path) else None
+            if current_inode != inode:
+                return  # another process compacted meanwhile
+            entries, _ = read_journal(self.journal_path, journal_offset)
+            apply_entries(documents, entries)
+            self._write_snapshot(documents)
+        with self._lock:
+            self._refresh()
+
+    def _write_snapshot(self, documents: dict):
+        # under the exclusive file lock: the snapshot and the journal change together for readers
+        IndexSnapshot.write(self.snapshot_path, documents)
+        open(self.journal_path, "wb").close()
+
+    def rebuild(self, pages):
+        """Indexes every page of the collection from scratch"""
+        documents = {page_data["_id"]: page_terms(page_data["title"], page_data.get("raw_text", ""))
+                     for page_data in pages.find({}, {"title": 1, "raw_text": 1})}
+        with self._lock:
+            with self._file_lock():
+                self._write_snapshot(documents)
+            self._refresh()
+        return len(documents)
+
+    def _ensure_built(self, pages):
+        if exists(self.snapshot_path):
+            return
+        with self._file_lock():
+            if not exists(self.snapshot_path):
+                documents = {page_data["_id"]: page_terms(page_data["title"], page_data.get("raw_text", ""))
+                             for page_data in pages.find({}, {"title": 1, "raw_text": 1})}
+                self._write_snapshot(documents)
+
+    def _query_terms(self, search_query: str):
+        """The query's words, the last one being expanded to the words it prefixes"""
+        words = [word for term in search_terms(search_query) for word in tokenize(term)]
+        if not words:
+            return []
+        query_terms = [[word] for word in words[:-1]]
+        last_word = words[-1]
+        expansions = {last_word}
+        if self._snapshot is not None:
+            expansions.update(term for _, term in self._snapshot.prefixed_terms(last_word, MAX_PREFIX_EXPANSIONS))
+        for _, terms in self._overlay.values():
+            expansions.update(term for term in terms if term.startswith(last_word))
+        query_terms.append(sorted(expansions)[:MAX_PREFIX_EXPANSIONS])
+        return query_terms
+
+    def ranked_pages(self, search_query: str):
+        """Names of the pages matching the query and their BM25 scores, best first"""
+        with self._lock:
+            self._refresh()
+            snapshot = self._snapshot
+            removed_ids = set()
+            total_length = sum(length for length, _ in self._overlay.values())
+            if snapshot is not None:
+                removed_ids = {snapshot.doc_ids[name] for name in self._removed if name in snapshot.doc_ids}
+                total_length += snapshot.total_length - sum(snapshot.doc_lengths[doc] for doc in removed_ids)
+            docs_count = len(self._overlay) + (snapshot.n_docs - len(removed_ids) if snapshot is not None else 0)
+            if not docs_count:
+                return []
+            average_length = total_length / docs_count
+
+            scores = Counter()
+            for expansions in self._query_terms(search_query):
+                for term in expansions:
+                    # postings keyed by snapshot doc index (int) or overlay page name (str)
+                    postings = []
+                    term_index = snapshot.find_term(term) if snapshot is not None else None
+                    if term_index is not None:
+                        postings.extend((doc, frequency, snapshot.doc_lengths[doc])
+                                        for doc, frequency in snapshot.postings(term_index)
+                                        if doc not in removed_ids)
+                    postings.extend((name, terms[term], length)
+                                    for name, (length, terms) in self._overlay.items() if term in terms)
+                    if not postings:
+                        continue
+                    idf = math.log(1 + (docs_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for doc, frequency, length in postings:
+                        scores[doc] += idf * frequency * (K1 + 1) / (
+                            frequency + K1 * (1 - B + B * length / average_length))
+
+            return [(snapshot.doc_name(doc) if isinstance(doc, int) else doc, score)
+                    for doc, score in scores.most_common()]
+
+    def search(self, pages, search_query: str, page: int, per_page: int):
+        self._ensure_built(pages)
+        ranked = self.ranked_pages(search_query)
+        selected = ranked[page * per_page:(page + 1) * per_page]
+        found = {page_data["_id"]: page_data
+                 for page_data in pages.find({"_id": {"$in": [name for name, _ in selected]}}, RESULT_FIELDS)}
+        results = []
+        for name, score in selected:
+            if name in found:
+                results.append(dict(found[name], score=score))
+        return results, len(ranked) > (page + 1) * per_page
+
+
+SEARCH_BACKENDS = {"mongo": MongoTextSearch,
+                   "inverted_index": InvertedIndexSearch}
+
+_backend = None
+
+
+def get_search_backend():
+    """The search backend picked by SEARCH_BACKEND, one per process"""
+    global _backend
+    if _backend is None:
+        _backend = SEARCH_BACKENDS[SEARCH_BACKEND]()
+    return _backend
@@ -0,0 +1,144 @@
+"""The word lists users' identities are picked from (pokémons, adjectives, jobs, cities and
+sexual orientations), packed in a single binary file that is memory-mapped on first use.
+
+Loading the source files (a 900KB JSON among them) used to happen when `tools.users` was
+imported, in every worker and script. The packed file is built from them the first time it's
+needed, and again whenever one of them is newer. Being mapped read-only, its pages are shared
+by all the processes of the machine, forked workers included.
+
+File layout, in the byte order of the machine that built it: the header "=4sI" (magic, number
+of tables), then for each table a uint32 count of strings followed by count + 1 uint32 offsets
+of its strings, relative to the table's UTF-8 blob that comes right after. Blobs are padded to
+4 bytes, so that the next table's integers are aligned."""
+import json
+import mmap
+import os
+from os import path
+import struct
+import threading
+from types import SimpleNamespace
+
+DATA_FILES_FOLDER = path.join(path.dirname(path.realpath(__file__)), "data/")
+TABLES_PATH = path.join(DATA_FILES_FOLDER, "identity.tables")
+MAGIC = b"WLI2"
+HEADER = struct.Struct("=4sI")
+UINT = struct.Struct("=I")
+# the fields of a city's entry (name and departement) are joined with this
+FIELD_SEPARATOR = "\t"
+
+TABLE_NAMES = ("pokemons", "adjectives", "jobs", "cities", "sexual_orient")
+SOURCE_FILES = ("pokemons.py", "adjectifs.txt", "metiers.txt", "villes.json", "sexualite.txt")
+
+
+def _read_lines(filename: str):
+    with open(path.join(DATA_FILES_FOLDER, filename)) as data_file:
+        return data_file.read().splitlines()
+
+
+def load_sources() -> dict:
+    """The tables, read from their source files"""
+    from .data import pokemons
+    with open(path.join(DATA_FILES_FOLDER, "villes.json")) as cities_file:
+        cities = [FIELD_SEPARATOR.join(city) for city in json.load(cities_file)]
+    # the pokémons are numbered from 1, without gaps
+    return {"pokemons": [pokemons.pokemon[poke_id] for poke_id in range(1, len(pokemons.pokemon) + 1)],
+            "adjectives": _read_lines("adjectifs.txt"),
+            "jobs": _read_lines("metiers.txt"),
+            "cities": cities,
+            "sexual_orient": _read_lines("sexualite.txt")}
+
+
+def write_tables(tables: dict, tables_path: str = TABLES_PATH):
+    """Packs the tables, written to a temporary file first so that readers never see half a file"""
+    chunks = [HEADER.pack(MAGIC, len(TABLE_NAMES))]
+    for name in TABLE_NAMES:
+        encoded = [string.encode("utf8") for string in tables[name]]
+        offsets = [0]
+        for string in encoded:
+            offsets.append(offsets[-1] + len(string))
+        chunks.append(struct.pack("=%dI" % (len(encoded) + 2), len(encoded), *offsets))
+        chunks.extend(encoded)
+        chunks.append(b"\0" * (-offsets[-1] % 4))
+
+    tmp_path = "%s.%d.tmp" % (tables_path, os.getpid())
+    with open(tmp_path, "wb") as tables_file:
+        tables_file.write(b"".join(chunks))
+    os.replace(tmp_path, tables_path)
+
+
+class PackedTable:
+    """A read-only list of strings, decoded on access from the mapped file"""
+
+    def __init__(self, buffer: memoryview, start: int):
+        self.count = UINT.unpack_from(buffer, start)[0]
+        offsets_start = start + UINT.size
+        blob_start = offsets_start + (self.count + 1) * UINT.size
+        self._offsets = buffer[offsets_start:blob_start].cast("I")
+        self._blob = buffer[blob_start:blob_start + self._offsets[self.count]]
+        blob_size = self._offsets[self.count]
+        self.end = blob_start + blob_size + (-blob_size % 4)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("table index out of range")
+        return str(self._blob[self._offsets[index]:self._offsets[index + 1]], "utf8")
+
+
+class CitiesTable(PackedTable):
+
+    def __getitem__(self, index: int):
+        return tuple(super().__getitem__(index).split(FIELD_SEPARATOR))
+
+
+class IdentityTables:
+
+    def __init__(self, tables_path: str = TABLES_PATH):
+        with open(tables_path, "rb") as tables_file:
+            self._mmap = mmap.mmap(tables_file.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+        magic, tables_count = HEADER.unpack_from(buffer)
+        if magic != MAGIC or tables_count != len(TABLE_NAMES):
+            raise ValueError("%s isn't an identity tables file" % tables_path)
+        position = HEADER.size
+        for name in TABLE_NAMES:
+            table = (CitiesTable if name == "cities" else PackedTable)(buffer, position)
+            setattr(self, name, table)
+            position = table.end
+
+
+def is_outdated(tables_path: str = TABLES_PATH) -> bool:
+    if not path.exists(tables_path):
+        return True
+    with open(tables_path, "rb") as tables_file:
+        # a file packed by a previous version of the format
+        if tables_file.read(len(MAGIC)) != MAGIC:
+            return True
+    built_at = path.getmtime(tables_path)
+    return any(path.getmtime(path.join(DATA_FILES_FOLDER, filename)) > built_at for filename in SOURCE_FILES)
+
+
+_tables = None
+_tables_lock = threading.Lock()
+
+
+def get_tables() -> IdentityTables:
+    """The identity tables, mapped on first call (and packed beforehand if needed)"""
+    global _tables
+    if _tables is None:
+        with _tables_lock:
+            if _tables is None:
+                try:
+                    if is_outdated():
+                        write_tables(load_sources())
+                    _tables = IdentityTables()
+                except OSError:
+                    # a read-only install without a packed file, the tables are kept in memory
+                    tables = load_sources()
+                    tables["cities"] = [tuple(city.split(FIELD_SEPARATOR)) for city in tables["cities"]]
+                    _tables = SimpleNamespace(**tables)
+    return _tables
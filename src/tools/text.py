@@ -0,0 +1,77 @@
+from html import unescape
+import re
+import unicodedata
+
+from markupsafe import Markup, escape
+
+TAG_REGEX = re.compile('<[^<]+?>')
+
+
+def html_to_text(html: str) -> str:
+    """Plain text of rendered markdown (not escaped anymore, it's up to the templates)"""
+    return unescape(TAG_REGEX.sub('', html))
+
+
+def make_snippet(text: str, length: int = 300) -> str:
+    """Cuts the text at the last word boundary before `length` characters"""
+    text = text.strip()
+    if len(text) <= length:
+        return text
+    return text[:length].rsplit(None, 1)[0] + "..."
+
+
+def remove_accents(text: str) -> str:
+    return ''.join(c for c in unicodedata.normalize('NFD', text)
+                   if unicodedata.category(c) != 'Mn')
+
+
+def title_sort_key(title: str) -> str:
+    """Key used to sort the pages alphabetically: lowercase, without accents nor leading article"""
+    text = remove_accents(title).lower().strip()
+    if text.startswith(("le", "la", "l'", "les")):
+        text = re.sub(r"^(le|l'|la|les)\s+", "", text)
+    return text
+
+
+def title_first_letter(title: str) -> str:
+    sort_key = title_sort_key(title)
+    return sort_key[0] if sort_key else "#"
+
+
+def search_terms(search_query: str) -> list:
+    """Words of a search query, without the text search operators"""
+    return [term.strip('"') for term in search_query.split()
+            if term.strip('"') and not term.startswith("-")]
+
+
+def highlight_snippet(text: str, terms: list, length: int = 300) -> Markup:
+    """Snippet of the text around the first occurrence of one of the terms, with the
+    terms' occurrences wrapped in <mark>. Matching ignores case and accents."""
+    folded = remove_accents(text).lower()
+    if len(folded) != len(text):
+        # the offsets of the folded text wouldn't match the original one's
+        folded = text.lower()
+    folded_terms = [remove_accents(term).lower() for term in terms]
+    folded_terms = [term for term in folded_terms if term]
+    if not folded_terms:
+        return escape(make_snippet(text, length))
+
+    pattern = re.compile("|".join(re.escape(term) for term in sorted(folded_terms, key=len, reverse=True)))
+    first_match = pattern.search(folded)
+    start = 0 if first_match is None else max(first_match.start() - length // 4, 0)
+    if start > 0:
+        # not starting in the middle of a word
+        space = text.find(" ", start)
+        start = space + 1 if 0 <= space < first_match.start() else start
+    end = min(start + length, len(text))
+
+    snippet = Markup("...") if start > 0 else Markup()
+    position = start
+    for match in pattern.finditer(folded, start, end):
+        snippet += escape(text[position:match.start()])
+        snippet += Markup("<mark>%s</mark>") % text[match.start():match.end()]
+        position = match.end()
+    snippet += escape(text[position:end])
+    if end < len(text):
+        snippet += Markup("...")
+    return snippet
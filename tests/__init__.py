@@ -0,0 +1,5 @@
+# the wiki's modules are imported from src/, as when it's run from there
+import sys
+from os.path import dirname, join, realpath
+
+sys.path.insert(0, join(dirname(dirname(realpath(__file__))), "src"))
@@ -0,0 +1,97 @@
+from base64 import urlsafe_b64encode
+import datetime
+import json
+import unittest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from pymongo import ASCENDING, DESCENDING
+
+from config import SEARCH_MAX_PAGES
+from tools.models import keyset_page, encode_token, decode_token, decode_offset, SearchResults
+
+SORT = [("sort_key", ASCENDING), ("_id", ASCENDING)]
+
+
+def raw_token(values) -> str:
+    """A token holding what encode_token would never write"""
+    return urlsafe_b64encode(json.dumps(values).encode("utf8")).decode("ascii")
+
+
+
+@unittest.skipIf(mongomock is None, "needs mongomock")
+class KeysetPageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = mongomock.MongoClient()["wikiloult"]["pages"]
+        # a few sort keys shared by many documents: pages boundaries fall amid ties
+        self.collection.insert_many([{"_id": "page %02d" % i, "sort_key": "abc"[i % 3]} for i in range(23)])
+        self.expected = [document["_id"] for document in self.collection.find().sort(SORT)]
+
+    def walk_forward(self, per_page: int):
+        pages, token = [], None
+        while True:
+            page = keyset_page(self.collection, {}, SORT, per_page, after=token)
+            pages.append(page)
+            if page.next_token is None:
+                return pages
+            token = page.next_token
+
+    def test_forward(self):
+        for per_page in (1, 4, 5, 23, 50):
+            pages = self.walk_forward(per_page)
+            self.assertEqual([document["_id"] for page in pages for document in page.items], self.expected)
+            self.assertIsNone(pages[0].previous_token)
+            self.assertTrue(all(page.previous_token for page in pages[1:]))
+
+    def test_backward(self):
+        for per_page in (1, 4, 5):
+            pages = self.walk_forward(per_page)
+            backward, token = [], pages[-1].previous_token
+            while token is not None:
+                page = keyset_page(self.collection, {}, SORT, per_page, before=token)
+                backward.append(page)
+                token = page.previous_token
+            self.assertEqual([page.items for page in reversed(backward)], [page.items for page in pages[:-1]])
+            self.assertTrue(all(page.next_token for page in backward))
+
+    def test_descending(self):
+        sort = [("sort_key", DESCENDING), ("_id", ASCENDING)]
+        expected = [document["_id"] for document in self.collection.find().sort(sort)]
+        first = keyset_page(self.collection, {}, sort, 7)
+        second = keyset_page(self.collection, {}, sort, 7, after=first.next_token)
+        self.assertEqual([document["_id"] for document in first.items + second.items], expected[:14])
+        back = keyset_page(self.collection, {}, sort, 7, before=second.previous_token)
+        self.assertEqual(back.items, first.items)
+
+    def test_invalid_tokens_give_the_first_page(self):
+        first = keyset_page(self.collection, {}, SORT, 5)
+        for token in ("n'importe quoi", encode_token(["a"]), encode_token(["a", {"$ne": None}]),
+                      raw_token([{"$foo": 1}, "a"]), raw_token({"sort_key": "a"}), raw_token(["a", {"$oid": "zz"}]),
+                      raw_token(["a", {"$date": "abc"}]), raw_token(["a", {"$date": 10 ** 30}]),
+                      raw_token(["a", 10 ** 30]), raw_token([["a"], "b"]), "W" * 2000 + "10"):
+            self.assertEqual(keyset_page(self.collection, {}, SORT, 5, after=token).items, first.items, token)
+            self.assertEqual(keyset_page(self.collection, {}, SORT, 5, before=token).items, first.items, token)
+
+
+class TokenTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        values = ["é", 3, datetime.datetime(2020, 1, 2, 3, 4, 5, 6000), None]
+        self.assertEqual(decode_token(encode_token(values)), values)
+        self.assertIsNone(decode_token(""))
+        self.assertIsNone(decode_token("%%%"))
+        self.assertIsNone(decode_token(raw_token([1, {"$oid": "zz"}])))
+        self.assertIsNone(decode_token(raw_token(-2 ** 63 - 1)))
+        self.assertIsNone(decode_token(urlsafe_b64encode(b"[" * 100000).decode("ascii")))
+
+    def test_offsets_are_clamped(self):
+        self.assertEqual(decode_offset(encode_token(5), 10), 5)
+        self.assertEqual(decode_offset(encode_token(10 ** 12), 10), 10)
+        self.assertEqual(decode_offset(raw_token(10 ** 30), 10), 0)
+        self.assertEqual(decode_offset(encode_token(-3), 10), 0)
+        self.assertEqual(decode_offset(encode_token(True), 10), 0)
+        self.assertEqual(SearchResults(None, "q", encode_token(10 ** 12), 20).page, SEARCH_MAX_PAGES - 1)
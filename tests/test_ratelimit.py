@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from limits.storage import storage_from_string
+
+from tools import ratelimit
+from tools.ratelimit import MongoLimitsStorage, SQLiteLimitsStorage
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1600000000.0
+
+    def time(self):
+        return self.now
+
+
+class StorageTests:
+    """Tests shared by both storages, run with a clock that only moves when told to"""
+
+    def make_storage(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(ratelimit, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage = self.make_storage()
+
+    def test_fixed_window(self):
+        self.assertEqual(self.storage.get("key"), 0)
+        self.assertEqual([self.storage.incr("key", 60) for _ in range(3)], [1, 2, 3])
+        self.assertEqual(self.storage.incr("key", 60, amount=2), 5)
+        self.assertEqual(self.storage.get("key"), 5)
+        self.assertEqual(self.storage.get("other key"), 0)
+        self.assertAlmostEqual(self.storage.get_expiry("key"), self.clock.now + 60, places=2)
+
+        # the window doesn't move with the hits
+        self.clock.now += 59
+        self.assertEqual(self.storage.incr("key", 60), 6)
+        self.clock.now += 1
+        self.assertEqual(self.storage.get("key"), 0)
+        self.assertEqual(self.storage.incr("key", 60), 1)
+        self.assertAlmostEqual(self.storage.get_expiry("key"), self.clock.now + 60, places=2)
+
+    def test_elastic_expiry(self):
+        self.storage.incr("key", 60, elastic_expiry=True)
+        self.clock.now += 50
+        self.assertEqual(self.storage.incr("key", 60, elastic_expiry=True), 2)
+        self.clock.now += 50
+        self.assertEqual(self.storage.get("key"), 2)
+        self.assertAlmostEqual(self.storage.get_expiry("key"), self.clock.now + 10, places=2)
+
+    def test_clear_and_reset(self):
+        self.storage.incr("key", 60)
+        self.storage.incr("other key", 60)
+        self.storage.clear("key")
+        self.assertEqual(self.storage.get("key"), 0)
+        self.assertEqual(self.storage.get("other key"), 1)
+        self.storage.reset()
+        self.assertEqual(self.storage.get("other key"), 0)
+        self.assertTrue(self.storage.check())
+
+
+@unittest.skipIf(mongomock is None, "needs mongomock")
+class MongoLimitsStorageTest(StorageTests, unittest.TestCase):
+
+    def make_storage(self):
+        return MongoLimitsStorage("wikiloult+mongodb://",
+                                  collection=mongomock.MongoClient()["wikiloult"]["rate_limits"])
+
+
+class SQLiteLimitsStorageTest(StorageTests, unittest.TestCase):
+
+    def make_storage(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        return storage_from_string("wikiloult+sqlite:///" + os.path.join(folder, "limits.sqlite"))
+
+    def test_shared_by_connections(self):
+        other_storage = SQLiteLimitsStorage("wikiloult+sqlite://" + self.storage.path)
+        self.storage.incr("key", 60)
+        self.assertEqual(other_storage.incr("key", 60), 2)
+        self.assertEqual(self.storage.get("key"), 2)
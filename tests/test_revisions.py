@@ -0,0 +1,67 @@
+import os
+import unittest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from config import REVISION_SNAPSHOT_INTERVAL
+from tools import models
+from tools.delta import make_delta, apply_delta
+
+
+class DeltaTest(unittest.TestCase):
+
+    def assertRoundTrip(self, old_text, new_text):
+        self.assertEqual(apply_delta(old_text, make_delta(old_text, new_text)), new_text)
+
+    def test_round_trip(self):
+        old_text = "# Titre\n\nune ligne\ndeux lignes\ntrois lignes\n"
+        self.assertRoundTrip(old_text, old_text)
+        self.assertRoundTrip(old_text, "# Titre\n\nune ligne\ndeux lignes modifiées\ntrois lignes\nquatre\n")
+        self.assertRoundTrip(old_text, "")
+        self.assertRoundTrip("", old_text)
+
+    def test_round_trip_without_final_newline(self):
+        self.assertRoundTrip("a\nb\nc", "a\nb\nc\nd")
+        self.assertRoundTrip("a\nb\nc\n", "a\nb")
+        self.assertRoundTrip("a\r\nb\r\n", "a\r\nc\r\n")
+
+    def test_unchanged_lines_are_copied(self):
+        old_text = "".join("ligne %d\n" % i for i in range(100))
+        delta = make_delta(old_text, old_text.replace("ligne 50\n", "ligne cinquante\n"))
+        self.assertEqual(delta, [50, -1, "ligne cinquante\n", 49])
+
+
+@unittest.skipIf(mongomock is None, "needs mongomock")
+class RevisionsTest(unittest.TestCase):
+
+    def setUp(self):
+        models._client, models._client_pid = mongomock.MongoClient(), os.getpid()
+        # mongomock can't create capped collections, the feed is an ordinary one here
+        models._recent_edits_checked = True
+        self.page_cnctr = models.WikiPagesConnector()
+
+    def tearDown(self):
+        models._client, models._client_pid = None, None
+
+    def test_revisions_across_snapshots(self):
+        versions = ["version 0\n"]
+        self.page_cnctr.create_page("page", versions[0], "Page", "cookie")
+        for i in range(1, 2 * REVISION_SNAPSHOT_INTERVAL + 5):
+            versions.append(versions[-1] + "ligne %d\n" % i if i % 3 else versions[-1].replace("version", "v"))
+            self.page_cnctr.edit_page("page", versions[i], "Page", "cookie")
+
+        stored = self.page_cnctr.revisions.find({"page": "page"})
+        self.assertEqual(sorted(revision["rev"] for revision in stored if "markdown" in revision),
+                         list(range(0, len(versions), REVISION_SNAPSHOT_INTERVAL)))
+        for rev, markdown_content in enumerate(versions):
+            revision = self.page_cnctr.get_revision_markdown("page", rev)
+            self.assertEqual(revision["markdown"], markdown_content, "revision %d" % rev)
+            self.assertNotIn("delta", revision)
+
+    def test_missing_revision(self):
+        self.page_cnctr.create_page("page", "contenu", "Page", "cookie")
+        self.assertIsNone(self.page_cnctr.get_revision_markdown("page", 1))
+        self.assertIsNone(self.page_cnctr.get_revision_markdown("autre page", 0))
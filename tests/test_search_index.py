@@ -0,0 +1,66 @@
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+from tools.search import IndexSnapshot, InvertedIndexSearch, page_terms
+
+DOCUMENTS = {"Pikachu": page_terms("Pikachu", "un pokémon électrique, très électrique"),
+             "Évoli": page_terms("Évoli", "un pokémon qui évolue"),
+             "Vide": (0, {})}
+
+
+class IndexSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = join(self.folder, "pages.index")
+        IndexSnapshot.write(self.path, DOCUMENTS)
+        self.snapshot = IndexSnapshot(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        self.assertEqual(self.snapshot.n_docs, 3)
+        self.assertEqual(self.snapshot.documents(), DOCUMENTS)
+        self.assertEqual(self.snapshot.total_length, sum(length for length, _ in DOCUMENTS.values()))
+
+    def test_terms(self):
+        self.assertIsNone(self.snapshot.find_term("absent"))
+        postings = dict(self.snapshot.postings(self.snapshot.find_term("electrique")))
+        self.assertEqual({self.snapshot.doc_name(doc): frequency for doc, frequency in postings.items()},
+                         {"Pikachu": 2})
+        self.assertEqual([term for _, term in self.snapshot.prefixed_terms("ev", 10)], ["evoli", "evolue"])
+        self.assertEqual(len(list(self.snapshot.prefixed_terms("", 2))), 2)
+
+    def test_not_a_snapshot(self):
+        with open(self.path, "wb") as index_file:
+            index_file.write(b"\0" * 64)
+        with self.assertRaises(ValueError):
+            IndexSnapshot(self.path)
+
+
+class InvertedIndexSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_journal_and_compaction(self):
+        writer, reader = InvertedIndexSearch(self.folder), InvertedIndexSearch(self.folder)
+        writer.update_page("Pikachu", "Pikachu", "un pokémon électrique")
+        writer.update_page("Évoli", "Évoli", "un pokémon")
+        self.assertEqual([name for name, _ in reader.ranked_pages("electrique")], ["Pikachu"])
+
+        writer.compact()
+        writer.update_page("Salamèche", "Salamèche", "un pokémon de feu, pas électrique")
+        writer.remove_page("Évoli")
+        self.assertEqual({name for name, _ in reader.ranked_pages("pokemon")}, {"Pikachu", "Salamèche"})
+        # a new snapshot, and a journal shorter than what the reader had read
+        writer.compact()
+        writer.update_page("Évoli", "Évoli", "de retour")
+        self.assertEqual({name for name, _ in reader.ranked_pages("pokemon")}, {"Pikachu", "Salamèche"})
+        self.assertEqual([name for name, _ in reader.ranked_pages("retour")], ["Évoli"])